@@ -0,0 +1,302 @@
+# Tested with Python2.7 on Linux Fedora x86_64 v24
+
+"""Benchmarks sainsburys_webpage_scraper.get_ripe_fruits_json() against a local synthetic catalog server.
+
+The server (run in its own process so it does not show up in the scraper's numbers) serves a lister page in the same
+"productLister listView" markup as RIPE_FRUITS_URL and one product page per product in the same "productText" markup
+as the real product pages, with a configurable no. of products, product page size, latency and error rate.
+
+Example:
+	$ python benchmark_sainsburys_webpage_scraper.py --products 500 --latency 0.05 --workers 16
+	products: 500 (0 skipped) in 12.59s over 3 runs
+	products/sec: 119.2
+	per-product latency: p50 120.4ms, p99 193.2ms
+	peak RSS: 52.7MB
+"""
+
+import argparse
+import BaseHTTPServer
+import gzip
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import SocketServer
+import sainsburys_webpage_scraper
+from cStringIO import StringIO
+import time
+
+LISTER_PATH = '/lister.html'
+
+LISTER_PAGE = '''<html>
+<head><title>Ripe &amp; ready | Sainsbury's</title></head>
+<body>
+<div id="page"><div id="main"><div id="content"><div id="productsContainer"><div id="productLister">
+<ul class="productLister listView">
+%s
+</ul>
+</div></div></div></div></div>
+</body>
+</html>'''
+
+LISTER_ITEM = '''<li>
+	<div class="product "><div class="productInner">
+		<div class="productInfoWrapper"><div class="productInfo">
+			<h3><a href="%(link)s" >
+				Sainsbury's Synthetic Product %(id)s
+				<img src="http://c2.sainsburys.co.uk/wcsstore7.11.1.161/ExtendedSitesCatalogAssetStore/images/catalog/productImages/51/0000000202251/0000000202251_M.jpeg" alt="" />
+			</a></h3>
+		</div></div>
+		<div class="addToTrolleytabBox"><div class="addToTrolleytabContainer addItemBorderTop"><div class="pricingAndTrolleyOptions">
+			<!-- Start UserSubscribedOrNot.jspf --><!-- Start UserSubscribedOrNot.jsp --><!-- End UserSubscribedOrNot.jsp-->
+			<div id="addItem_%(id)s" class="priceTab activeContainer priceTabContainer">
+				<div class="pricing">
+					<p class="pricePerUnit">
+					&pound%(unit_price)s<abbr title="per">/</abbr><abbr title="unit"><span class="pricePerUnitUnit">unit</span></abbr>
+					</p>
+				</div>
+			</div>
+		</div></div></div>
+	</div></div>
+</li>'''
+
+PRODUCT_PAGE = '''<html>
+<head><title>Sainsbury's Synthetic Product %(id)s | Sainsbury's</title></head>
+<body>
+%(header)s
+<div id="page"><div id="main"><div id="content"><div class="section productContent">
+<div class="mainProductInfoWrapper"><div class="mainProductInfo"><div class="tabs"><div id="information">
+<productcontent><htmlcontent>
+<h3 class="productDataItemHeader">Description</h3>
+<div class="productText">
+<p>%(description)s</p>
+<p>Synthetic product page used for benchmarking.</p>
+</div>
+%(footer)s
+</htmlcontent></productcontent>
+</div></div></div></div>
+</div></div></div></div>
+</body>
+</html>'''
+
+# Repeated to pad product pages up to the requested size, roughly what the navigation/nutrition markup looks like.
+FILLER = '<div class="filler"><ul><li><a href="/shop/gb/groceries/fruit">Fruit</a></li><li>Ripe &amp; ready</li></ul><p>Lorem ipsum dolor sit amet.</p></div>\n'
+
+def build_lister_page(base_url, products):
+	items = []
+	for i in xrange(products):
+		product_id = 100000 + i
+		items.append(LISTER_ITEM % {'link': '%s/product/%s.html' % (base_url, product_id), 'id': product_id,
+									'unit_price': '%d.%02d' % (i % 7, (i * 37) % 100)})
+	return LISTER_PAGE % '\n'.join(items)
+
+def build_product_page(product_id, page_size):
+	page = PRODUCT_PAGE % {'id': product_id, 'description': 'Synthetic %s' % product_id, 'header': '', 'footer': ''}
+	fillers = max(0, page_size - len(page)) / len(FILLER)
+	page = PRODUCT_PAGE % {'id': product_id, 'description': 'Synthetic %s' % product_id,
+						   'header': FILLER * (fillers / 2), 'footer': FILLER * (fillers - fillers / 2)}
+	return page + ' ' * max(0, page_size - len(page))
+
+class CatalogRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves the lister page at LISTER_PATH and the product pages at /product/<id>.html.
+
+	Product pages are delayed by the server's latency (+/- jitter) and fail with the server's error rate, half of
+	the failures being a "500 Internal Server Error" and half a connection closed without any response. If the 
+	server's gzip is True pages are gzipped for clients which accept it.
+	"""
+	protocol_version = 'HTTP/1.1'  # keep-alive
+	# Without these the headers and the body go out in separate small writes and delayed ACKs add ~40ms per page.
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		server = self.server
+		if self.path == LISTER_PATH:
+			self._send(200, server.lister_page)
+			return
+		if not self.path.startswith('/product/'):
+			self._send(404, 'Not found')
+			return
+
+		product_id = self.path[len('/product/'):].split('.')[0]
+		if server.latency:
+			time.sleep(max(0, random.uniform(server.latency - server.jitter, server.latency + server.jitter)))
+		if random.random() < server.error_rate:
+			if random.random() < 0.5:
+				self._send(500, 'Internal Server Error')
+			else:
+				self.close_connection = 1
+			return
+		page = server.product_pages.get(product_id)
+		if page is None:
+			page = server.product_pages[product_id] = build_product_page(product_id, server.page_size)
+		self._send(200, page)
+
+	def _send(self, status, body):
+		etag = '"%x"' % (hash(body) & 0xffffffff)
+		if status == 200 and self.headers.get('If-None-Match') == etag:
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		if status == 200 and self.server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+			body = self.server.gzipped(body)
+			self.send_response(status)
+			self.send_header('Content-Encoding', 'gzip')
+		else:
+			self.send_response(status)
+		self.send_header('Content-Type', 'text/html; charset=UTF-8')
+		self.send_header('Content-Length', str(len(body)))
+		if status == 200:
+			self.send_header('ETag', etag)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class CatalogServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__(self, products, page_size, latency, jitter, error_rate, gzip=False):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), CatalogRequestHandler)
+		self.gzip = gzip
+		self._gzipped = {}  # page -> gzipped page
+		self.page_size = page_size
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.lister_page = build_lister_page('http://127.0.0.1:%s' % self.server_address[1], products)
+		self.product_pages = {}
+
+	def gzipped(self, body):
+		if body not in self._gzipped:
+			f = StringIO()
+			with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gzip_file:
+				gzip_file.write(body)
+			self._gzipped[body] = f.getvalue()
+		return self._gzipped[body]
+
+def _serve(ready, products, page_size, latency, jitter, error_rate, gzip):
+	server = CatalogServer(products, page_size, latency, jitter, error_rate, gzip)
+	ready.send(server.server_address[1])
+	server.serve_forever()
+
+def start_catalog_server(products, page_size=40*1024, latency=0.0, jitter=0.0, error_rate=0.0, gzip=False):
+	"""Starts a CatalogServer in its own process and returns (process, lister page URL)."""
+	ready, child_ready = multiprocessing.Pipe()
+	process = multiprocessing.Process(target=_serve, args=(child_ready, products, page_size, latency, jitter, error_rate, gzip))
+	process.daemon = True
+	process.start()
+	port = ready.recv()
+	return process, 'http://127.0.0.1:%s%s' % (port, LISTER_PATH)
+
+def percentile(sorted_values, fraction):
+	if not sorted_values:
+		return 0.0
+	return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def run_benchmark(lister_url, runs=1, max_workers=sainsburys_webpage_scraper.MAX_WORKERS):
+	"""Runs get_ripe_fruits_json() against lister_url runs times and returns a dictionary of measurements.
+
+	Per-product latency is the time spent in get_product_page_details() (fetching and parsing the product's page).
+	"""
+	latencies = []
+	latencies_lock = multiprocessing.Lock()
+	get_product_page_details = sainsburys_webpage_scraper.get_product_page_details
+	def timed_get_product_page_details(*args, **kwargs):
+		start = time.time()
+		try:
+			return get_product_page_details(*args, **kwargs)
+		finally:
+			with latencies_lock:
+				latencies.append(time.time() - start)
+
+	original_url = sainsburys_webpage_scraper.RIPE_FRUITS_URL
+	sainsburys_webpage_scraper.RIPE_FRUITS_URL = lister_url
+	sainsburys_webpage_scraper.get_product_page_details = timed_get_product_page_details
+	products = skipped = 0
+	try:
+		start = time.time()
+		for _ in xrange(runs):
+			json_string = sainsburys_webpage_scraper.get_ripe_fruits_json(max_workers=max_workers)
+			if not json_string:
+				raise RuntimeError('Could not get the products listed on "%s"' % lister_url)
+			results = json.loads(json_string)['results']
+			products += len(results)
+		elapsed = time.time() - start
+		skipped = len(latencies) - products
+	finally:
+		sainsburys_webpage_scraper.RIPE_FRUITS_URL = original_url
+		sainsburys_webpage_scraper.get_product_page_details = get_product_page_details
+
+	latencies.sort()
+	return {
+		'runs': runs,
+		'products': products / runs,
+		'skipped': skipped / runs,
+		'seconds': elapsed,
+		'products_per_second': (products + skipped) / elapsed if elapsed else 0.0,
+		'latency_p50_ms': percentile(latencies, 0.50) * 1000,
+		'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,  # ru_maxrss is in kB on Linux
+	}
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmarks sainsburys_webpage_scraper against a local synthetic catalog server')
+	parser.add_argument('--products', type=int, default=100, help='no. of products listed (default: %(default)s)')
+	parser.add_argument('--page-size', type=int, default=40*1024, help='size of each product page in bytes (default: %(default)s)')
+	parser.add_argument('--latency', type=float, default=0.0, help='seconds the server waits before serving a product page (default: %(default)s)')
+	parser.add_argument('--jitter', type=float, default=0.0, help='max random +/- seconds added to the latency (default: %(default)s)')
+	parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of product page requests which fail (default: %(default)s)')
+	parser.add_argument('--gzip', action='store_true', help='gzip the pages for clients which accept it')
+	parser.add_argument('--runs', type=int, default=3, help='no. of times the whole lister is scraped (default: %(default)s)')
+	parser.add_argument('-w', '--workers', type=int, default=sainsburys_webpage_scraper.MAX_WORKERS,
+						help='max no. of product pages fetched at the same time (default: %(default)s)')
+	parser.add_argument('--stream-lister', action='store_true', help='parse the lister page while it is downloaded')
+	parser.add_argument('--incremental', action='store_true', help='parse product pages incrementally')
+	parser.add_argument('--fast-extract', action='store_true', help='scan product pages for the description instead of parsing them')
+	parser.add_argument('--parse-processes', type=int, default=0, help='no. of processes parsing product pages (default: %(default)s)')
+	parser.add_argument('--adaptive', action='store_true', help='retry failed requests and adapt the no. of requests in flight')
+	parser.add_argument('--record', metavar='FILE', help='save the pages served in this HTTP archive, for --replay')
+	parser.add_argument('--replay', metavar='FILE',
+						help='scrape the pages saved in this HTTP archive by --record instead of starting the server')
+	parser.add_argument('--json', action='store_true', help='print the measurements as a JSON string')
+	args = parser.parse_args(argv)
+
+	logging.getLogger().setLevel(logging.CRITICAL)  # failed products are expected with --error-rate
+	if args.replay:
+		process = None
+		http_archive = sainsburys_webpage_scraper.configure_http_archive(args.replay)
+		lister_url = http_archive.offsets.keys()[0]  # the first page requested
+	else:
+		process, lister_url = start_catalog_server(args.products, args.page_size, args.latency, args.jitter, args.error_rate, args.gzip)
+		sainsburys_webpage_scraper.configure_http_archive(args.record, record=True)
+	try:
+		sainsburys_webpage_scraper.STREAM_LISTER = args.stream_lister
+		sainsburys_webpage_scraper.INCREMENTAL_PARSE = args.incremental
+		sainsburys_webpage_scraper.FAST_EXTRACT = args.fast_extract
+		sainsburys_webpage_scraper.configure_parse_pool(args.parse_processes)
+		sainsburys_webpage_scraper.configure_session(pool_maxsize=max(args.workers, sainsburys_webpage_scraper.POOL_MAXSIZE))
+		sainsburys_webpage_scraper.configure_fetch_scheduler(args.adaptive)
+		measurements = run_benchmark(lister_url, args.runs, args.workers)
+	finally:
+		sainsburys_webpage_scraper.configure_parse_pool(0)
+		sainsburys_webpage_scraper.configure_http_archive(None)
+		if process is not None:
+			process.terminate()
+
+	if args.json:
+		print json.dumps(measurements, indent=4, sort_keys=True)
+		return
+	print 'products: %(products)s (%(skipped)s skipped) in %(seconds).2fs over %(runs)s runs' % measurements
+	print 'products/sec: %(products_per_second).1f' % measurements
+	print 'per-product latency: p50 %(latency_p50_ms).1fms, p99 %(latency_p99_ms).1fms' % measurements
+	print 'peak RSS: %(peak_rss_mb).1fMB' % measurements
+
+
+if __name__ == '__main__':
+	main()
@@ -1,18 +1,209 @@
 # Tested with Python2.7 on Linux Fedora x86_64 v24 
 
+import argparse
+from array import array
+import BaseHTTPServer
+import bisect
+from collections import deque, OrderedDict
+import cProfile
 from cStringIO import StringIO
+import csv
 from decimal import Decimal
+import hashlib
 import json
 import logging
-from lxml import html
+from lxml import etree, html
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import re
 import requests
+import requests.adapters
+import socket
+import SocketServer
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import urllib
+import urlparse
 
 logging.basicConfig(format="[%(levelname)-8s %(filename)s: %(lineno)3s - %(funcName)-25s] %(message)s", level=logging.WARNING)
 
 RIPE_FRUITS_URL = 'http://hiring-tests.s3-website-eu-west-1.amazonaws.com/2015_Developer_Scrape/5_products.html'
 TIMEOUT = 5
+MAX_WORKERS = 1  # max no. of product pages fetched at the same time, 1 means fetch them one after the other
 
-def get_ripe_fruits_json():
+# When fetching concurrently, at most this many products per worker are kept waiting to be returned in order. This
+# lets the other workers carry on while a slow product page holds up the head of the queue without unbounded buffering.
+PENDING_PER_WORKER = 4
+
+MAX_LISTER_PAGES = 1000  # safety limit on the no. of lister pages visited by crawl()
+
+DELTA_FIELDS = ('unit_price', 'title', 'description', 'size')  # compared by get_ripe_fruits_delta_json()
+
+# In sharded mode (see plan_shards()) the product pages are fetched by shard workers, in separate processes or on 
+# separate machines, sharing an SQLite work queue. A product claimed by a worker which has not finished it within 
+# SHARD_CLAIM_TIMEOUT seconds is assumed to be lost (e.g. the worker was killed) and is handed to the next worker.
+SHARD_CLAIM_TIMEOUT = 600
+SHARD_DB_TIMEOUT = 60  # seconds a worker waits for another one to release the SQLite database's lock
+SHARD_MAX_ATTEMPTS = 3  # a product whose page could not be fetched is retried until it was attempted this many times
+
+# Every HTTP request goes through a single shared requests.Session (see get_session()) so connections are kept alive 
+# and reused, after the first product page each further one only costs a single round trip to the same host.
+POOL_CONNECTIONS = 10  # no. of different hosts whose connections are kept in the pool
+POOL_MAXSIZE = 10  # max no. of keep-alive connections per host, should be at least MAX_WORKERS
+POOL_BLOCK = True  # when True, requests wait for a free connection instead of going over POOL_MAXSIZE per host
+
+# Content codings asked for on every request. Pages are decompressed as they are read, so "size" and the byte counts 
+# are those of the markup while only the compressed bytes go over the wire ("bytes.wire" in the metrics). "br" is 
+# only asked for if urllib3 can decode it, i.e. if the brotli package is installed.
+try:
+	from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+except ImportError:  # urllib3 < 1.25, without brotli support
+	ACCEPT_ENCODING = 'gzip,deflate'
+
+_session = None
+_session_lock = threading.Lock()
+
+# Optional on-disk HTTP cache (see HttpCache), pages are revalidated with If-None-Match/If-Modified-Since so unchanged
+# pages cost a "304 Not Modified" response instead of the full markup. It is disabled while HTTP_CACHE_DIR is None.
+HTTP_CACHE_DIR = None
+HTTP_CACHE_MAX_BYTES = 100 * 1024 * 1024  # least recently used pages are evicted above this total size
+HTTP_CACHE_MAX_AGE = 0  # seconds during which a cached page is used without revalidating it with the server
+
+_http_cache = None
+
+# Optional fetch scheduler (see FetchScheduler) which rate limits the requests to each host, retries failed requests
+# with a jittered exponential backoff and adapts the no. of requests in flight to each host to how it copes (AIMD).
+# It is disabled while _fetch_scheduler is None, see configure_fetch_scheduler().
+RETRIES = 3  # no. of times a failed request is retried before giving up on it
+RETRY_STATUSES = (429, 500, 502, 503, 504)  # statuses for which a request is retried, as are connection errors
+BACKOFF_BASE = 0.5  # seconds, the n-th retry waits a random time between 0 and BACKOFF_BASE * 2**n seconds
+BACKOFF_MAX = 30  # seconds, max wait before a retry
+RATE_LIMIT = None  # max requests per second to each host, None for no limit
+RATE_BURST = 10  # max requests sent to a host in a burst when RATE_LIMIT allows it
+INITIAL_CONCURRENCY = 2  # no. of requests in flight to a host at first, it then grows by ~1 per round trip while healthy
+LATENCY_TOLERANCE = 4  # a response is unhealthy if it takes over this many times the fastest response from its host
+
+_fetch_scheduler = None
+
+# Optional HTTP archive (see HttpArchive) which either records every response received, or replays them from the 
+# archive instead of sending any request, so the same pages can be scraped again offline, e.g. to compare parsers on 
+# identical inputs. It is disabled while _http_archive is None, see configure_http_archive().
+_http_archive = None
+
+# When STREAM_LISTER is True the lister page is parsed as it is downloaded and each product's page is requested as 
+# soon as its <li> element is parsed, which is then freed (see StreamedListerItems), instead of parsing the whole 
+# lister page first. Only used by get_ripe_fruits_json() and write_ripe_fruits_ndjson().
+STREAM_LISTER = False
+
+# When INCREMENTAL_PARSE is True product pages are parsed chunk by chunk as they are downloaded and the parser stops 
+# building the tree as soon as the description is found (the rest of the page is only counted for the "size" field).
+INCREMENTAL_PARSE = False
+CHUNK_SIZE = 8192  # bytes read from the socket at a time when parsing incrementally
+
+# When FAST_EXTRACT is True the description is first looked for by scanning the product page's markup for the first 
+# <div class="productText"> and its first <p> (see get_product_description_fast()) without building a tree. Whenever the 
+# markup around them is not plain enough for the scan to be sure it finds what the XPath selectors would, the page is
+# parsed with lxml as usual. With VERIFY_FAST_EXTRACT both are run and any mismatch is logged (the lxml result is used).
+FAST_EXTRACT = False
+VERIFY_FAST_EXTRACT = False
+
+# Parsing product pages is CPU bound and, in threads, limited to a single core by the GIL. With PARSE_PROCESSES > 0
+# the threads fetching product pages hand the markup to a pool of that many processes (see configure_parse_pool()) 
+# which return compact tuples of fields (see parse_product_page_fields()) rather than lxml elements. Pages parsed
+# incrementally (see INCREMENTAL_PARSE) are always parsed in the fetching threads.
+PARSE_PROCESSES = 0
+
+_parse_pool = None
+
+# While crawling, lister and product pages are fetched by their canonical URL (see canonicalize_url()), without these 
+# query parameters which only track where the visitor came from, so the same page is not fetched twice.
+TRACKING_QUERY_PARAMS = ('gclid', 'fbclid', 'msclkid', 'mc_cid', 'mc_eid', 'cmpid')
+TRACKING_QUERY_PARAM_PREFIXES = ('utm_',)
+
+# Different product URLs often serve the same markup (variants, redirects), the details extracted from the last
+# EXTRACTION_MEMO_SIZE distinct product pages are kept by the SHA-1 of the markup so identical pages are only parsed
+# once per run (see ExtractionMemo and start_run()). 0 disables it.
+EXTRACTION_MEMO_SIZE = 1024
+
+_extraction_memo = None
+
+# Optional append-only journal of the products whose page was fetched (see Journal), so that a run which died can be
+# resumed without fetching them again. It is disabled while _journal is None, see configure_journal().
+JOURNAL_FSYNC = False  # if True each record is also fsync()ed, so it survives the machine crashing, not only the process
+
+_journal = None
+_failure_causes = threading.local()  # causes counted by count_failure() for the product being fetched, for the journal
+
+# When METRICS_ENABLED is True the time spent in each phase ("request", "transfer", "parse", "xpath", "serialize", 
+# and "product" for each product as a whole), the bytes downloaded and the failures by cause are collected (see 
+# get_metrics()). When it is False the instrumentation only costs a check of this flag.
+METRICS_ENABLED = False
+TIMER_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, float('inf'))  # seconds
+
+# Every XPath expression used to locate an element, by field. A field can list more than one expression, in which case 
+# the expressions after the first are fallbacks tried in order until one of them finds something (see select()).
+# If the webpage's layout changes the selectors can be overridden without changing the code, with a JSON file holding
+# a dictionary of the same shape (e.g. {"product_link": ["div/h3/a"]}) passed to load_selectors() or --selectors.
+DEFAULT_SELECTORS = {
+	# The <ul> element of RIPE_FRUITS_URL which lists the products.
+	'product_list': ['''body/
+							div[@id='page']/
+								div[@id='main']/
+									div[@id='content']/
+										div[@id='productsContainer']/
+											div[@id='productLister']/
+												ul[@class='productLister listView']'''],
+	# The link to the next page of a lister page, if the products are listed over more than one page.
+	'next_page': ["//ul[@class='pages']/li[@class='next']/a"],
+	# Relative to a product's <li> element.
+	'pricing_and_trolley_options': ['''div[@class='product ']/
+											div[@class='productInner']/
+												div[@class='addToTrolleytabBox']/
+													div[@class='addToTrolleytabContainer addItemBorderTop']/
+														div[@class='pricingAndTrolleyOptions']'''],
+	# Relative to a product's <div id="addItem_****"> element.
+	'unit_price': ['''div[@class='pricing']/
+							p[@class='pricePerUnit']'''],
+	# Relative to a product's <li> element.
+	'product_link': ['''div[@class='product ']/
+							div[@class='productInner']/
+								div[@class='productInfoWrapper']/
+									div[@class='productInfo']/
+										h3/
+											a'''],
+	# The <div class="productText"> element of a product's page.
+	'product_text': ['''body/
+							div[@id='page']/
+								div[@id='main']/
+									div[@id='content']/
+										div[@class='section productContent']/
+											div[@class='mainProductInfoWrapper']/
+												div[@class='mainProductInfo']/
+													div[@class='tabs']/
+														div[@id='information']/
+															productcontent/
+																htmlcontent/
+																	div[@class='productText']'''],
+	# Relative to the <div class="productText"> element.
+	'description': ['p'],
+}
+SELECTORS_FILE = None
+
+# In daemon mode (see serve_snapshots()) the products are scraped again every SERVE_INTERVAL seconds and the latest and 
+# previous JSON strings are served from memory over HTTP, on SERVE_HOST:<port>.
+SERVE_HOST = '127.0.0.1'
+SERVE_INTERVAL = 300
+
+_selectors = {}  # field -> list of compiled etree.XPath, see load_selectors()
+_overridden_selectors = set()  # fields whose selectors are not the DEFAULT_SELECTORS
+
+def get_ripe_fruits_json(max_workers=MAX_WORKERS):
 	""" Uses lxml's support for XPath syntax to return a JSON string based on the products listed in RIPE_FRUITS_URL.
 	
 	Example (if RIPE_FRUITS_URL listed 2 products):
@@ -41,67 +232,932 @@ def get_ripe_fruits_json():
 	"total" is the sum of the "unit_price" across all products.
 	"title" and "unit_price" are both retrieved directly from RIPE_FRUITS_URL and not from the embedded link (same result).
 	
+	Up to max_workers product pages are fetched concurrently (see iter_product_details_dicts()), the products are still
+	listed in the same order as they appear on RIPE_FRUITS_URL.
+
 	This function returns an empty string in two cases:
 		1 - Connection to RIPE_FRUITS_URL timed out.
 		2 - HTML parser unable to locate the <ul> element which lists the products.
 	"""
-	try:
-		response = requests.get(RIPE_FRUITS_URL, timeout=TIMEOUT)
-	except Exception as ex:
-		logging.error('Connecting to "%s" failed with:\n\t%s' %(RIPE_FRUITS_URL, ex))
+	store = get_ripe_fruits_store(max_workers)
+	if store is None:
 		return ''
+	return get_store_json(store)
 
-	tree = html.parse(StringIO(response.content), parser=html.HTMLParser())
-	ul = tree.xpath('''body/
-						div[@id='page']/
-							div[@id='main']/
-								div[@id='content']/
-									div[@id='productsContainer']/
-										div[@id='productLister']/
-											ul[@class='productLister listView']''')
-	try:
-		ul = ul[0]
-	except IndexError:
-		logging.error('XPath expression failed')
-		return ''
+def get_store_json(store):
+	"""Returns the JSON string of get_ripe_fruits_json() for the products in store (a ProductStore)."""
+	# total is cast back to a str since json.dumps cannot handle decimal.Decimal types
+	with timed('serialize'):
+		return json.dumps({'results': _JsonArray(store), 'total': str(store.total())}, indent=4, sort_keys=True)  
+
+def get_ripe_fruits_store(max_workers=MAX_WORKERS):
+	"""Returns a ProductStore with the products listed in RIPE_FRUITS_URL, in the same order as they are listed.
+
+	Products whose details could not be retrieved are skipped. Returns None in the same cases where 
+	get_ripe_fruits_json() returns an empty string.
+	"""
+	start_run()
+	ul_children = get_lister_items(RIPE_FRUITS_URL)
+	if ul_children is None:
+		return None
 	
 	i = 0
-	total = 0
-	results = []
+	store = ProductStore()
 	
-	# The <ul> tag has multiple <li> tags, each which represents a single product.
-	ul_children = ul.getchildren()
-	logging.info('Found %s products listed on "%s"' %(len(ul_children), RIPE_FRUITS_URL))
-	for li in ul_children:  
+	for product_details_dict in iter_product_details_dicts(ul_children, max_workers):
 		i += 1
 		logging.info('Processing product number %s' %i)
-		product_details_dict = get_product_details_dict(li)
 		if not product_details_dict:
 			logging.warn('Could not build product_details_dict for product number %s, skipping' %i)
 			continue
-		results.append(product_details_dict)
+		store.append(product_details_dict)
+	if isinstance(ul_children, StreamedListerItems) and not ul_children.succeeded:
+		return None
+	return store
+
+def get_lister_items(url):
+	"""Returns the <li> elements of the lister page at url, each of which represents a single product: a list, or a
+	StreamedListerItems if STREAM_LISTER is True.
+
+	Returns None if the page could not be fetched or (unless STREAM_LISTER is True, see StreamedListerItems.found) 
+	the <ul> element which lists the products could not be found.
+	"""
+	if STREAM_LISTER:
+		try:
+			response = fetch(url, stream=True)
+		except Exception as ex:
+			logging.error('Connecting to "%s" failed with:\n\t%s' %(url, ex))
+			count_failure('connection')
+			return None
+		return StreamedListerItems(url, response)
+
+	tree = get_lister_tree(url)
+	if tree is None:
+		return None
+	ul_children = get_product_list_items(tree)
+	if ul_children is None:
+		return None
+	logging.info('Found %s products listed on "%s"' %(len(ul_children), url))
+	return ul_children
+
+class StreamedListerItems(object):
+	"""Iterable over the <li> elements of a lister page which lists products (see get_product_list_items()), each 
+	yielded as soon as it is parsed while the rest of the page is still being downloaded from response.
+
+	Each <li> element is removed from the tree once the next one is asked for, so only the elements around the 
+	product being yielded are kept in memory whatever the no. of products. It can only be iterated once.
+	found is False until the <ul> element listing the products has been found ("XPath expression failed" is logged
+	if the whole page was parsed without finding it). failed is True if reading the page failed midway, in which case
+	the iteration stops early. The products are only all listed if succeeded is True once iterated.
+	"""
+	def __init__(self, url, response):
+		self.url = url
+		self.response = response
+		self.found = False
+		self.failed = False
+		self.ul = None
+		self.items = 0
+
+	@property
+	def succeeded(self):
+		return self.found and not self.failed
+
+	def __iter__(self):
+		parser = etree.HTMLPullParser(events=('end',), tag='li')
+		parser.set_element_class_lookup(html.HtmlElementClassLookup())  # same elements as html.parse(), see get_product_add_item_div()
+		try:
+			chunks = iter(self.response.iter_content(CHUNK_SIZE))
+			while True:
+				try:
+					chunk = next(chunks)
+				except StopIteration:
+					break
+				except Exception as ex:
+					logging.error('Connecting to "%s" failed with:\n\t%s' %(self.url, ex))
+					count_failure('connection')
+					self.failed = True
+					return
+				count('bytes.lister_pages', len(chunk))
+				with timed('parse'):
+					parser.feed(chunk)
+				for li in self._read_items(parser):
+					yield li
+			with timed('parse'):
+				parser.close()
+			for li in self._read_items(parser):
+				yield li
+		finally:
+			self.response.close()
+
+		if not self.found:
+			logging.error('XPath expression failed')
+			count_failure('xpath')
+		logging.info('Found %s products listed on "%s"' %(self.items, self.url))
+
+	def _read_items(self, parser):
+		for _, li in parser.read_events():
+			ul = li.getparent()
+			if ul is None or ul.tag != 'ul':
+				continue
+			if not self.found:
+				# The path up to the <ul> has been parsed already, so the same selector as for a whole page works.
+				uls = select('product_list', li.getroottree())
+				if not uls or uls[0] is not ul:
+					continue
+				self.found = True
+				self.ul = ul
+			elif ul is not self.ul:
+				continue
+			self.items += 1
+			yield li
+			del ul[:ul.index(li) + 1]  # with anything before it, e.g. comments
+
+class _JsonArray(list):
+	"""Lets json.dumps() encode the rows of a ProductStore as a JSON array without building a list of all of them.
+
+	With indent set, json's encoder only calls len() and iterates over lists, so each product_details_dict is built 
+	just before it is encoded and can be freed right after.
+	"""
+	def __init__(self, rows):
+		list.__init__(self)
+		self.rows = rows
+
+	def __len__(self):
+		return len(self.rows)
+
+	def __iter__(self):
+		return iter(self.rows)
+
+def write_ripe_fruits_ndjson(out, max_workers=MAX_WORKERS):
+	"""Streaming version of get_ripe_fruits_json(), writes the products listed in RIPE_FRUITS_URL to out (a file-like 
+	object) as newline-delimited JSON, one product per line as soon as its details are retrieved.
+
+	The last line holds the "total" (as in get_ripe_fruits_json()), the no. of products written and skipped, e.g.:
+		{"description": "Apricots", "size": "38kb", "title": "Sainsbury's Apricot Ripe & Ready x5", "unit_price": "3.50"}
+		{"description": "Kiwi", "size": "38kb", "title": "Sainsbury's Kiwi Fruit, Ripe & Ready x4", "unit_price": "1.80"}
+		{"products": 2, "skipped": 0, "total": "5.30"}
+
+	Products are not kept in memory once written, so memory use does not grow with the no. of products.
+	Returns False without writing anything in the same cases where get_ripe_fruits_json() returns an empty string.
+	"""
+	start_run()
+	ul_children = get_lister_items(RIPE_FRUITS_URL)
+	if ul_children is None:
+		return False
+
+	i = 0
+	skipped = 0
+	total = 0
+
+	for product_details_dict in iter_product_details_dicts(ul_children, max_workers):
+		i += 1
+		if not product_details_dict:
+			logging.warn('Could not build product_details_dict for product number %s, skipping' %i)
+			skipped += 1
+			continue
+		with timed('serialize'):
+			out.write(json.dumps(product_details_dict, sort_keys=True) + '\n')
+		out.flush()
 		total += Decimal(product_details_dict['unit_price'])
+	if isinstance(ul_children, StreamedListerItems) and not ul_children.succeeded:
+		return False
 
-	# total is cast back to a str since json.dumps cannot handle decimal.Decimal types
-	return json.dumps({'results': results, 'total': str(total)}, indent=4, sort_keys=True)  
+	out.write(json.dumps({'products': i - skipped, 'skipped': skipped, 'total': str(total)}, sort_keys=True) + '\n')
+	out.flush()
+	return True
+
+def get_ripe_fruits_delta_json(snapshot_path, max_workers=MAX_WORKERS):
+	"""Returns a JSON string with the changes to the products listed in RIPE_FRUITS_URL since the snapshot saved at 
+	snapshot_path by the previous call, and saves the new snapshot there.
+
+	Products are recognised across runs by their id (see get_product_id()). Only the pages of products which are new
+	or whose "unit_price" or "title" changed on RIPE_FRUITS_URL are fetched, with If-None-Match/If-Modified-Since 
+	using the validators in the snapshot, the other products keep the "size" and "description" from the snapshot.
+
+	Example (if since the previous run a product was added, one was removed and one's price went down):
+		{
+		    "added": [
+		        {
+		            "description": "Kiwi", 
+		            "id": "572163", 
+		            "size": "38kb", 
+		            "title": "Sainsbury's Kiwi Fruit, Ripe & Ready x4", 
+		            "unit_price": "1.80"
+		        }
+		    ], 
+		    "changed": [
+		        {
+		            "description": "Apricots", 
+		            "id": "149117", 
+		            "previous": {
+		                "unit_price": "3.50"
+		            }, 
+		            "size": "38kb", 
+		            "title": "Sainsbury's Apricot Ripe & Ready x5", 
+		            "unit_price": "3.20"
+		        }
+		    ], 
+		    "removed": [
+		        {
+		            "description": "Avocados", 
+		            "id": "7555699", 
+		            "size": "38kb", 
+		            "title": "Sainsbury's Avocado Ripe & Ready XL Loose 300g", 
+		            "unit_price": "1.50"
+		        }
+		    ], 
+		    "total": "5.00", 
+		    "unchanged": 0
+		}
+
+	"previous" holds the earlier values of the fields which changed and "total" is the sum of the "unit_price" of 
+	all the products currently listed. If a product's page could not be fetched its record from the snapshot is kept 
+	(so it is fetched again by the next call), it is neither "changed" nor "removed" but its current "unit_price" is 
+	the one in the "total". If there is no snapshot yet every product is "added".
+
+	Returns an empty string (and leaves the snapshot untouched) in the same cases as get_ripe_fruits_json().
+	"""
+	start_run()
+	tree = get_lister_tree(RIPE_FRUITS_URL)
+	if tree is None:
+		return ''
+	ul_children = get_product_list_items(tree)
+	if ul_children is None:
+		return ''
+
+	snapshot = load_snapshot(snapshot_path)
+	new_snapshot = OrderedDict()
+	unit_prices = {}  # product id -> its "unit_price" on RIPE_FRUITS_URL now, which may not be in new_snapshot yet
+	added = []
+	changed = []
+	unchanged = 0
+
+	pool = ThreadPool(max_workers) if max_workers > 1 else None
+	try:
+		pending = deque()  # (product id, previous record, page_info, AsyncResult or product_details_dict)
+		for i, li in enumerate(ul_children, 1):
+			product_id = get_product_id(li)
+			product_details_dict, link = get_product_listing_details(li) if product_id is not None else ({}, None)
+			if not product_details_dict:
+				logging.warn('Could not build product_details_dict for product number %s, skipping' %i)
+				continue
+			if product_id in new_snapshot:
+				continue  # listed twice
+			unit_prices[product_id] = product_details_dict['unit_price']
+
+			previous_record = snapshot.get(product_id)
+			if previous_record is not None and all(previous_record[field] == product_details_dict[field] for field in ('unit_price', 'title')):
+				unchanged += 1
+				new_snapshot[product_id] = previous_record
+				continue
+
+			page_info = dict((field, previous_record.get(field)) for field in ('size', 'description', 'etag', 'last_modified')) if previous_record else {}
+			new_snapshot[product_id] = None  # keeps the listing order
+			if pool is None:
+				pending.append((product_id, previous_record, page_info, get_product_page_details(product_details_dict, link, page_info)))
+			else:
+				pending.append((product_id, previous_record, page_info, pool.apply_async(get_product_page_details, (product_details_dict, link, page_info))))
+
+		for product_id, previous_record, page_info, product_details_dict in pending:
+			product_details_dict = _get_pending_result(product_details_dict)
+			if not product_details_dict:
+				logging.warn('Could not build product_details_dict for product "%s", keeping its previous record' % product_id)
+				if previous_record is None:
+					del new_snapshot[product_id]
+				else:
+					new_snapshot[product_id] = previous_record
+				continue
+
+			record = dict(product_details_dict, id=product_id, etag=page_info.get('etag'), last_modified=page_info.get('last_modified'))
+			new_snapshot[product_id] = record
+			if previous_record is None:
+				added.append(_get_delta_record(record))
+			else:
+				changed_record = _get_delta_record(record)
+				changed_record['previous'] = dict((field, previous_record[field]) for field in DELTA_FIELDS if previous_record[field] != record[field])
+				changed.append(changed_record)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+	removed = [_get_delta_record(record) for product_id, record in snapshot.items() if product_id not in new_snapshot]
+	write_snapshot(snapshot_path, new_snapshot)
+
+	total = sum_unit_prices({'unit_price': unit_prices[product_id]} for product_id in new_snapshot)
+	with timed('serialize'):
+		return json.dumps({'added': added, 'changed': changed, 'removed': removed, 'unchanged': unchanged, 'total': str(total)}, 
+						  indent=4, sort_keys=True)
+
+def _get_delta_record(record):
+	return dict((field, record[field]) for field in ('id',) + DELTA_FIELDS)
+
+def load_snapshot(snapshot_path):
+	"""Returns the snapshot saved at snapshot_path by write_snapshot() as an OrderedDict of product id -> record, or
+	an empty OrderedDict if there is no snapshot there yet.
+	"""
+	if not os.path.exists(snapshot_path):
+		return OrderedDict()
+	with open(snapshot_path) as f:
+		snapshot = json.load(f, object_pairs_hook=OrderedDict)
+	return snapshot['products']
+
+def write_snapshot(snapshot_path, snapshot):
+	"""Saves snapshot (a dictionary of product id -> record with the DELTA_FIELDS, "etag" and "last_modified") at 
+	snapshot_path, replacing the previous one only once the new one is completely written.
+	"""
+	tmp_path = snapshot_path + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		json.dump({'products': snapshot}, f, indent=1)
+	os.rename(tmp_path, snapshot_path)
+
+def get_lister_tree(url):
+	"""Returns the parsed tree of the lister page at url (e.g. RIPE_FRUITS_URL), or None if it could not be fetched."""
+	try:
+		response = fetch(url)
+	except Exception as ex:
+		logging.error('Connecting to "%s" failed with:\n\t%s' %(url, ex))
+		count_failure('connection')
+		return None
+
+	lister_page_content = response.content
+	count('bytes.lister_pages', len(lister_page_content))
+	with timed('parse'):
+		return html.parse(StringIO(lister_page_content), parser=html.HTMLParser())
+
+def get_product_list_items(tree):
+	"""Returns the list of <li> elements of a lister page's tree, each of which represents a single product.
+
+	Returns None if the <ul> element which lists the products could not be found.
+	"""
+	ul = select('product_list', tree)
+	try:
+		ul = ul[0]
+	except IndexError:
+		logging.error('XPath expression failed')
+		count_failure('xpath')
+		return None
+
+	# The <ul> tag has multiple <li> tags, each which represents a single product.
+	return ul.getchildren()
+
+def get_crawl_json(seed_urls, max_workers=MAX_WORKERS, max_lister_pages=MAX_LISTER_PAGES):
+	"""Returns a JSON string with the products listed on every lister page reachable from seed_urls (see crawl()).
+
+	Example (if a single seed URL listed 2 products over 2 pages):
+		{
+		    "listers": [
+		        {
+		            "results": [
+		                {
+		                    "description": "Apricots", 
+		                    "size": "38kb", 
+		                    "title": "Sainsbury's Apricot Ripe & Ready x5", 
+		                    "unit_price": "3.50"
+		                }, 
+		                {
+		                    "description": "Kiwi", 
+		                    "size": "38kb", 
+		                    "title": "Sainsbury's Kiwi Fruit, Ripe & Ready x4", 
+		                    "unit_price": "1.80"
+		                }
+		            ], 
+		            "total": "5.30", 
+		            "url": "http://.../fruit.html"
+		        }
+		    ], 
+		    "products": 2, 
+		    "total": "5.30"
+		}
+
+	Each entry of "listers" has the same shape as the output of get_ripe_fruits_json() with the products of all 
+	of the lister's pages, in the same order as they are listed. A product listed on more than one lister appears 
+	in each of them, but is only fetched once and only counted once in the top-level "total" and "products" (the 
+	no. of distinct products whose details were retrieved).
+
+	Returns an empty string if none of the seed URLs could be fetched.
+	"""
+	listers, products = crawl(seed_urls, max_workers, max_lister_pages)
+	if not listers:
+		return ''
+
+	lister_dicts = []
+	for lister_url, product_urls in listers.items():
+		results = [products[product_url] for product_url in product_urls if products[product_url]]
+		lister_dicts.append({'url': lister_url, 'results': results, 'total': str(sum_unit_prices(results))})
+
+	results = [product_details_dict for product_details_dict in products.values() if product_details_dict]
+	with timed('serialize'):
+		return json.dumps({'listers': lister_dicts, 'products': len(results), 'total': str(sum_unit_prices(results))}, indent=4, sort_keys=True)
+
+def crawl(seed_urls, max_workers=MAX_WORKERS, max_lister_pages=MAX_LISTER_PAGES):
+	"""Crawls the lister pages in seed_urls and the pages they link to through their "next page" link (see 
+	iter_lister_pages()) and fetches the pages of the products listed on them.
+
+	Product URLs are de-duplicated (by their canonical form, see canonicalize_url()) so each product page is fetched 
+	exactly once, by a pool of max_workers threads, while the remaining lister pages are still being crawled.
+
+	Returns a (listers, products) tuple:
+		listers: an OrderedDict of seed URL -> list of the URLs of the products listed on it or its following pages
+		products: a dictionary of product URL -> product_details_dict (an empty dictionary if it could not be built)
+	Seed URLs which could not be fetched or whose products could not be located are left out of listers.
+	"""
+	start_run()
+	listers = OrderedDict()
+	products = {}
+	pool = ThreadPool(max_workers) if max_workers > 1 else None
+	try:
+		for seed_url, lister_url, listed_products in iter_lister_pages(seed_urls, max_lister_pages):
+			product_urls = listers.setdefault(seed_url, [])
+			for product_url, product_details_dict in listed_products:
+				product_urls.append(product_url)
+				if product_url in products:
+					continue
+				if pool is None:
+					products[product_url] = get_product_page_details(product_details_dict, product_url)
+				else:
+					products[product_url] = pool.apply_async(get_product_page_details, (product_details_dict, product_url))
+
+		for product_url, product_details_dict in products.items():
+			products[product_url] = _get_pending_result(product_details_dict)
+			if not products[product_url]:
+				logging.warn('Could not build product_details_dict for product "%s", skipping' % product_url)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+	return listers, products
+
+def iter_lister_pages(seed_urls, max_lister_pages=MAX_LISTER_PAGES):
+	"""Crawls the lister pages in seed_urls and the pages they link to through their "next page" link, without
+	fetching any product page.
+
+	Lister pages are fetched one after the other from a frontier queue, each URL at most once and at most 
+	max_lister_pages in total. For each lister page whose products could be located this yields a 
+	(seed URL it was reached from, lister page URL, [(product URL, product_details_dict), ...]) tuple, where the 
+	product URLs are canonical (see canonicalize_url()) and the product_details_dicts only have the details found 
+	on the lister page (see get_product_listing_details()). Products whose details could not be found are left out.
+
+	A lister page reached from several seed URLs (e.g. a seed URL which is another one's 2nd page) is yielded once
+	for each of them, with the products found when it was fetched, and its "next page" link is followed for each of
+	them too, so every seed URL gets all the products of the pages it leads to.
+	"""
+	lister_pages = {}  # lister page URL -> ([(product URL, product_details_dict), ...], next page URL) or None
+	reached = set()  # (seed URL, lister page URL)
+	frontier = deque((seed_url, seed_url) for seed_url in seed_urls)  # (lister page URL, seed URL it was reached from)
+	while frontier:
+		lister_url, seed_url = frontier.popleft()
+		lister_url = canonicalize_url(lister_url)
+		if (seed_url, lister_url) in reached:
+			continue
+		if lister_url not in lister_pages:
+			if len(lister_pages) >= max_lister_pages:
+				logging.warn('Stopped crawling after %s lister pages, %s left in the frontier' %(len(lister_pages), len(frontier) + 1))
+				return
+			lister_pages[lister_url] = _get_lister_page(lister_url)
+		reached.add((seed_url, lister_url))
+
+		lister_page = lister_pages[lister_url]
+		if lister_page is None:
+			continue
+		listed_products, next_page_url = lister_page
+		if next_page_url:
+			frontier.append((next_page_url, seed_url))
+		yield seed_url, lister_url, listed_products
+
+def _get_lister_page(lister_url):
+	"""Returns a ([(product URL, product_details_dict), ...], next page URL or None) tuple for iter_lister_pages(),
+	or None if the lister page could not be fetched or its products located.
+	"""
+	tree = get_lister_tree(lister_url)
+	if tree is None:
+		return None
+	lis = get_product_list_items(tree)
+	if lis is None:
+		return None
+	logging.info('Found %s products listed on "%s"' %(len(lis), lister_url))
+
+	listed_products = []
+	for li in lis:
+		product_details_dict, link = get_product_listing_details(li)
+		if product_details_dict:
+			listed_products.append((canonicalize_url(urlparse.urljoin(lister_url, link)), product_details_dict))
+
+	next_page = select('next_page', tree)
+	if next_page and next_page[0].get('href'):
+		return listed_products, urlparse.urljoin(lister_url, next_page[0].get('href'))
+	return listed_products, None
+
+def plan_shards(db_path, seed_urls, shards, max_lister_pages=MAX_LISTER_PAGES):
+	"""Crawls the lister pages reachable from seed_urls (see iter_lister_pages()) and queues the products listed on 
+	them in the SQLite database at db_path (created if needed), each in one of shards shards picked by a hash of its 
+	canonical URL, for run_shard_worker() to fetch.
+
+	The products are numbered in the order they are first listed, which merge_shards() keeps. Products already queued
+	by an earlier call are not queued again. Returns the no. of products in the queue, or None if none of the seed 
+	URLs could be crawled.
+	"""
+	connection = _connect_shard_db(db_path)
+	try:
+		crawled = False
+		with connection:
+			connection.execute('BEGIN')
+			position = connection.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+			for seed_url, lister_url, listed_products in iter_lister_pages(seed_urls, max_lister_pages):
+				crawled = True
+				for product_url, product_details_dict in listed_products:
+					inserted = connection.execute('INSERT OR IGNORE INTO products (url, position, shard, listing) VALUES (?, ?, ?, ?)', 
+												  (product_url, position, get_shard(product_url, shards), json.dumps(product_details_dict)))
+					position += inserted.rowcount
+		return position if crawled else None
+	finally:
+		connection.close()
+
+def get_shard(product_url, shards):
+	"""Returns the shard (0 to shards - 1) of a canonical product URL, the same on every machine and every run."""
+	if isinstance(product_url, unicode):
+		product_url = product_url.encode('utf-8')
+	return int(hashlib.sha1(product_url).hexdigest()[:8], 16) % shards
+
+def run_shard_worker(db_path, shard, max_workers=MAX_WORKERS):
+	"""Fetches the pages of the products queued by plan_shards() in the given shard which are not done yet (including
+	the ones which failed less than SHARD_MAX_ATTEMPTS times, and the ones claimed by a worker which has not finished 
+	them within SHARD_CLAIM_TIMEOUT seconds), by a pool of max_workers threads, and saves their details in the queue.
+	A product whose last attempt was claimed by a worker which did not finish it in time is marked as failed.
+
+	Several workers can run at the same time on the same shard, or on different ones, each claims a few products at 
+	a time. Returns a (no. of products done by this worker, no. of products of the shard left failed) tuple, the 
+	latter being those which failed SHARD_MAX_ATTEMPTS times (a product which failed but was then done is not).
+	"""
+	start_run()
+	worker = '%s:%s' % (socket.gethostname(), os.getpid())
+	connection = _connect_shard_db(db_path)
+	done = 0
+	try:
+		while True:
+			claimed = _claim_shard_products(connection, shard, worker, max(1, max_workers) * PENDING_PER_WORKER)
+			if not claimed:
+				failed = connection.execute("SELECT COUNT(*) FROM products WHERE shard = ? AND status = 'failed'", (shard,)).fetchone()[0]
+				return done, failed
+			results = iter_product_page_details([(json.loads(listing), url) for url, listing in claimed], max_workers)
+			for (url, listing), product_details_dict in zip(claimed, results):
+				if product_details_dict:
+					done += 1
+				else:
+					logging.warn('Could not build product_details_dict for product "%s", skipping' % url)
+				connection.execute('UPDATE products SET status = ?, result = ?, worker = NULL WHERE url = ? AND worker = ?', 
+								   ('done' if product_details_dict else 'failed', json.dumps(product_details_dict) if product_details_dict else None, url, worker))
+	finally:
+		connection.close()
+
+def iter_product_page_details(listed_products, max_workers=MAX_WORKERS):
+	"""Yields get_product_page_details() for every (product_details_dict, link) in listed_products, in the same order,
+	with up to max_workers product pages fetched concurrently.
+	"""
+	if max_workers <= 1:
+		for product_details_dict, link in listed_products:
+			yield get_product_page_details(product_details_dict, link)
+		return
+
+	pool = ThreadPool(max_workers)
+	try:
+		pending = [pool.apply_async(get_product_page_details, (product_details_dict, link)) for product_details_dict, link in listed_products]
+		for product_details_dict in pending:
+			yield product_details_dict.get()
+	finally:
+		pool.terminate()
+		pool.join()
+
+def _claim_shard_products(connection, shard, worker, limit):
+	"""Claims up to limit products of shard for worker and returns their [(url, listing), ...]."""
+	now = time.time()
+	with connection:
+		connection.execute('BEGIN IMMEDIATE')  # no other worker can claim the same products in between
+		# A worker died (or is stuck) during the product's last attempt, so it would never be claimed again.
+		connection.execute('''UPDATE products SET status = 'failed', worker = NULL WHERE shard = ? AND status = 'claimed' AND 
+			claimed_at < ? AND attempts >= ?''', (shard, now - SHARD_CLAIM_TIMEOUT, SHARD_MAX_ATTEMPTS))
+		claimed = connection.execute('''SELECT url, listing FROM products WHERE shard = ? AND attempts < ? AND 
+			(status IN ('pending', 'failed') OR status = 'claimed' AND claimed_at < ?) ORDER BY position LIMIT ?''', 
+			(shard, SHARD_MAX_ATTEMPTS, now - SHARD_CLAIM_TIMEOUT, limit)).fetchall()
+		connection.executemany("UPDATE products SET status = 'claimed', worker = ?, claimed_at = ?, attempts = attempts + 1 WHERE url = ?", 
+							   [(worker, now, url) for url, listing in claimed])
+	return claimed
+
+def merge_shards(db_path):
+	"""Returns a JSON string with the same shape as get_ripe_fruits_json()'s with the products fetched by the shard 
+	workers (see run_shard_worker()), in the order they were first listed, and their exact "total".
+
+	The output only depends on the queue's contents, not on which worker fetched which product or when. Products not 
+	done yet (or which failed) are left out, with a warning. Returns an empty string if nothing was planned.
+	"""
+	connection = _connect_shard_db(db_path)
+	try:
+		store = ProductStore()
+		missing = 0
+		rows = connection.execute('SELECT status, result FROM products ORDER BY position')
+		planned = False
+		for status, result in rows:
+			planned = True
+			if status == 'done':
+				store.append(json.loads(result))
+			else:
+				missing += 1
+	finally:
+		connection.close()
+	if not planned:
+		return ''
+	if missing:
+		logging.warn('%s products are not done yet or failed, run their shard workers again' % missing)
+	return get_store_json(store)
+
+def run_shards(db_path, shards, max_workers=MAX_WORKERS):
+	"""Runs run_shard_worker() for each of the shards in its own process, at the same time, and waits for them.
+
+	Returns True if every worker exited normally.
+	"""
+	processes = [multiprocessing.Process(target=_run_shard_process, args=(db_path, shard, max_workers)) for shard in xrange(shards)]
+	for process in processes:
+		process.start()
+	for process in processes:
+		process.join()
+	return all(process.exitcode == 0 for process in processes)
+
+def _run_shard_process(db_path, shard, max_workers):
+	global _session, _parse_pool
+	# The parent's keep-alive connections and parse pool can't be shared with a forked process.
+	_session = None
+	_parse_pool = None
+	done, failed = run_shard_worker(db_path, shard, max_workers)
+	logging.info('Shard %s: %s products done, %s failed' %(shard, done, failed))
+
+def _connect_shard_db(db_path):
+	connection = sqlite3.connect(db_path, timeout=SHARD_DB_TIMEOUT, isolation_level=None)  # transactions are explicit
+	connection.execute('''CREATE TABLE IF NOT EXISTS products (
+		url TEXT PRIMARY KEY, position INTEGER NOT NULL, shard INTEGER NOT NULL, listing TEXT NOT NULL, 
+		status TEXT NOT NULL DEFAULT 'pending', result TEXT, worker TEXT, claimed_at REAL, attempts INTEGER NOT NULL DEFAULT 0)''')
+	connection.execute('CREATE INDEX IF NOT EXISTS products_by_shard ON products (shard, status, position)')
+	return connection
+
+def sum_unit_prices(product_details_dicts):
+	"""Returns the exact sum (a decimal.Decimal, or the int 0 if there are no products) of the products' "unit_price"."""
+	total = 0
+	for product_details_dict in product_details_dicts:
+		total += Decimal(product_details_dict['unit_price'])
+	return total
+
+class ProductStore(object):
+	"""Compact, column-backed list of product_details_dicts.
+
+	Instead of a dictionary per product each field is kept in a column: "unit_price" as an integer coefficient and 
+	exponent (so totals are exact and computed in bulk, see total()), "size" as an integer no. of kb and "title" and 
+	"description" as interned strings (descriptions such as "Avocados" repeat a lot). Fields which do not fit their 
+	column (and any other field) are kept in a per-product dictionary which only exists for such products.
+
+	Iterating over the store, or indexing it, yields the same dictionaries that were appended.
+	"""
+	# A store of 100,000 products takes ~3MB plus its distinct strings, a list of dictionaries takes ~30MB plus every 
+	# string. Missing values are None in the string columns and -1 in the "size" column.
+	__slots__ = ('_strings', '_titles', '_descriptions', '_price_coefficients', '_price_exponents', '_sizes', '_extras')
+
+	COLUMNS = ('title', 'unit_price', 'size', 'description')
+	_MAGIC = 'SWSCRAPER-COLUMNS\n'  # first line of a file written by write_columns()
+
+	def __init__(self):
+		self._strings = {}  # interned strings
+		self._titles = []
+		self._descriptions = []
+		self._price_coefficients = array('l')
+		self._price_exponents = array('b')
+		self._sizes = array('l')
+		self._extras = {}  # product index -> dictionary of the fields which do not fit the columns
+
+	def append(self, product_details_dict):
+		"""Adds a product_details_dict, which must have a "unit_price"."""
+		extras = dict((key, value) for key, value in product_details_dict.items() if key not in self.COLUMNS)
+
+		unit_price = product_details_dict['unit_price']
+		sign, digits, exponent = Decimal(unit_price).as_tuple()
+		coefficient = int(''.join(map(str, digits))) * (-1 if sign else 1)  # unit_price == coefficient * 10**exponent
+		if str(Decimal(unit_price)) != unit_price:  # e.g. ".5", the exact str is kept as well
+			extras['unit_price'] = unit_price
+
+		size = product_details_dict.get('size')
+		size_kb = -1
+		if size is not None:
+			if isinstance(size, basestring) and size.endswith('kb') and size[:-2].isdigit() and str(int(size[:-2])) == size[:-2]:
+				size_kb = int(size[:-2])
+			else:
+				extras['size'] = size
+
+		strings = []
+		for field in ('title', 'description'):
+			value = product_details_dict.get(field)
+			if isinstance(value, basestring):
+				value = self._strings.setdefault(value, value)
+			elif value is not None or field in product_details_dict:
+				extras[field] = value
+				value = None
+			strings.append(value)
+
+		self._price_coefficients.append(coefficient)  # first, it raises OverflowError for absurd prices
+		self._price_exponents.append(exponent)
+		self._sizes.append(size_kb)
+		self._titles.append(strings[0])
+		self._descriptions.append(strings[1])
+		if extras:
+			self._extras[len(self._titles) - 1] = extras
+
+	def __len__(self):
+		return len(self._titles)
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		if not 0 <= i < len(self):
+			raise IndexError('ProductStore index out of range')
+		product_details_dict = {'unit_price': str(Decimal(self._price_coefficients[i]).scaleb(self._price_exponents[i]))}
+		if self._sizes[i] >= 0:
+			product_details_dict['size'] = str(self._sizes[i])+'kb'
+		if self._titles[i] is not None:
+			product_details_dict['title'] = self._titles[i]
+		if self._descriptions[i] is not None:
+			product_details_dict['description'] = self._descriptions[i]
+		product_details_dict.update(self._extras.get(i, {}))
+		return product_details_dict
+
+	def __iter__(self):
+		for i in xrange(len(self)):
+			yield self[i]
+
+	def total(self):
+		"""Returns the exact sum of the products' "unit_price", as sum_unit_prices() does."""
+		if not len(self):
+			return 0
+		exponent = min(self._price_exponents)
+		if exponent == max(self._price_exponents):  # the usual case, e.g. every price in pence
+			coefficient = sum(self._price_coefficients)
+		else:
+			coefficient = sum(c * 10**(e - exponent) for c, e in zip(self._price_coefficients, self._price_exponents))
+		return Decimal(coefficient).scaleb(exponent)
+
+	def write_csv(self, out):
+		"""Writes the products to out (a file-like object) as CSV with a header row, one column per field.
+
+		Fields other than the COLUMNS come after them, sorted by name. Strings are encoded in UTF-8.
+		"""
+		fields = list(self.COLUMNS) + sorted(set(key for extras in self._extras.values() for key in extras) - set(self.COLUMNS))
+		writer = csv.writer(out)
+		writer.writerow(fields)
+		for product_details_dict in self:
+			row = []
+			for field in fields:
+				value = product_details_dict.get(field, '')
+				row.append(value.encode('utf-8') if isinstance(value, unicode) else value)
+			writer.writerow(row)
+
+	def write_columns(self, out):
+		"""Writes the products to out (a file-like object) in a compact binary, column by column format.
+
+		The file starts with the _MAGIC line and a JSON line with the no. of "rows" and the "columns", each with its 
+		"name", "type" and "bytes", which follow one after the other:
+			"int64"/"int8": little-endian integers, one per row
+			"utf8": a byte per row (1 if the row has a value), the rows' little-endian int64 end offsets and the 
+			        concatenated UTF-8 strings
+		The "extras" column holds the fields which do not fit the other columns as a JSON object. See read_columns().
+		"""
+		n = len(self)
+		columns = [
+			('unit_price_coefficient', 'int64', struct.pack('<%sq' % n, *self._price_coefficients)),
+			('unit_price_exponent', 'int8', struct.pack('<%sb' % n, *self._price_exponents)),
+			('size_kb', 'int64', struct.pack('<%sq' % n, *self._sizes)),
+			('title', 'utf8', self._pack_strings(self._titles)),
+			('description', 'utf8', self._pack_strings(self._descriptions)),
+			('extras', 'utf8', self._pack_strings([json.dumps(self._extras[i], sort_keys=True) if i in self._extras else None 
+												   for i in xrange(n)])),
+		]
+		out.write(self._MAGIC)
+		out.write(json.dumps({'rows': n, 'columns': [{'name': name, 'type': kind, 'bytes': len(data)} for name, kind, data in columns]}, 
+							 sort_keys=True) + '\n')
+		for name, kind, data in columns:
+			out.write(data)
+
+	@classmethod
+	def read_columns(cls, f):
+		"""Returns a ProductStore with the products written to the file-like object f by write_columns()."""
+		if f.readline() != cls._MAGIC:
+			raise ValueError('Not a file written by ProductStore.write_columns()')
+		header = json.loads(f.readline())
+		n = header['rows']
+		columns = {}
+		for column in header['columns']:
+			data = f.read(column['bytes'])
+			if column['type'] == 'utf8':
+				columns[column['name']] = cls._unpack_strings(data, n)
+			else:
+				columns[column['name']] = struct.unpack('<%s%s' % (n, 'q' if column['type'] == 'int64' else 'b'), data)
+
+		store = cls()
+		for i in xrange(n):
+			product_details_dict = {'unit_price': str(Decimal(columns['unit_price_coefficient'][i]).scaleb(columns['unit_price_exponent'][i]))}
+			if columns['size_kb'][i] >= 0:
+				product_details_dict['size'] = str(columns['size_kb'][i])+'kb'
+			for field in ('title', 'description'):
+				if columns[field][i] is not None:
+					product_details_dict[field] = columns[field][i]
+			if columns['extras'][i] is not None:
+				product_details_dict.update(json.loads(columns['extras'][i]))
+			store.append(product_details_dict)
+		return store
+
+	@staticmethod
+	def _pack_strings(values):
+		encoded = [value.encode('utf-8') if isinstance(value, unicode) else value or '' for value in values]
+		offsets = []
+		end = 0
+		for value in encoded:
+			end += len(value)
+			offsets.append(end)
+		return (struct.pack('<%sB' % len(values), *[value is not None for value in values]) + 
+				struct.pack('<%sq' % len(values), *offsets) + ''.join(encoded))
+
+	@staticmethod
+	def _unpack_strings(data, n):
+		present = struct.unpack('<%sB' % n, data[:n])
+		offsets = struct.unpack('<%sq' % n, data[n:n*9])
+		blob = data[n*9:]
+		values = []
+		start = 0
+		for i in xrange(n):
+			values.append(blob[start:offsets[i]].decode('utf-8') if present[i] else None)
+			start = offsets[i]
+		return values
+
+def iter_product_details_dicts(lis, max_workers=MAX_WORKERS):
+	"""Yields get_product_details_dict() for every <li> tag in lis, in the same order as lis.
+
+	With max_workers <= 1 the products are processed one after the other. Otherwise the details found directly in
+	the <li> tags are read in the calling thread (lxml trees should not be shared between threads) and the product
+	pages are fetched by a pool of max_workers threads, so a slow product page only holds up its own worker.
+
+	Products whose details could not be retrieved are yielded as an empty dictionary, as get_product_details_dict() does.
+	"""
+	if max_workers <= 1:
+		for li in lis:
+			yield get_product_details_dict(li)
+		return
+
+	pool = ThreadPool(max_workers)
+	try:
+		# Each item is either the AsyncResult of get_product_page_details() or {} for a product that already failed.
+		pending = deque()
+		for li in lis:
+			product_details_dict, link = get_product_listing_details(li)
+			if product_details_dict:
+				pending.append(pool.apply_async(get_product_page_details, (product_details_dict, link)))
+			else:
+				pending.append({})
+			while len(pending) >= max_workers * PENDING_PER_WORKER:
+				yield _get_pending_result(pending.popleft())
+		while pending:
+			yield _get_pending_result(pending.popleft())
+	finally:
+		pool.terminate()
+		pool.join()
+
+def _get_pending_result(pending_result):
+	if isinstance(pending_result, dict):
+		return pending_result
+	return pending_result.get()
 
 def get_product_details_dict(li):
 	"""Returns a dictionary with details of the product in the <li> tag.
 	
 	If any of the details could not be found an empty dictionary is returned even if other details were retrieved.
 	"""
+	product_details_dict, link = get_product_listing_details(li)
+	if not product_details_dict:
+		return {}
+	return get_product_page_details(product_details_dict, link)
+
+def get_product_listing_details(li):
+	"""Returns a (product_details_dict, link) tuple with the details of the product found directly in the <li> tag 
+	("unit_price" and "title") and the link to the product's individual page.
+
+	Returns ({}, None) if any of them could not be found.
+	"""
 	product_details_dict = {}
 
 	unit_price = get_product_unit_price(li)
 	if unit_price is None:
 		logging.error('Could not get "unit_price" for product')
-		return {}
+		return {}, None
 	product_details_dict['unit_price'] = unit_price
 
 	link_element = get_product_link_element(li)
 	if link_element is None:
 		logging.error('Could not get link to product page')
-		return {}
+		return {}, None
 	
 	product_details_dict['title'] = link_element.text.strip()
 	
@@ -109,43 +1165,926 @@ def get_product_details_dict(li):
 		link = link_element.values()[0]
 	except IndexError: 
 		logging.error('Could not get link to product page')
-		return {}
+		return {}, None
+
+	return product_details_dict, link
+
+def get_product_page_details(product_details_dict, link, page_info=None):
+	"""Fetches the product's individual page and adds "size" and "description" to product_details_dict.
+
+	See _get_product_page_details(), this wrapper times the whole product for the metrics and, with a journal (see
+	configure_journal()), records the product in it or, if the journal has it already, returns the recorded one
+	(with the "unit_price" and "title" in product_details_dict) without fetching its page.
+	"""
+	journal = _journal
+	if journal is None:
+		with timed('product'):
+			return _get_product_page_details(product_details_dict, link, page_info)
+
+	recorded_product_details_dict = journal.get(link)
+	if recorded_product_details_dict is not None:
+		count('journal.resumed')
+		recorded_product_details_dict.update(product_details_dict)
+		return recorded_product_details_dict
+	_failure_causes.causes = []
+	try:
+		with timed('product'):
+			product_details_dict = _get_product_page_details(product_details_dict, link, page_info)
+		journal.record(link, product_details_dict, _failure_causes.causes)
+	finally:
+		_failure_causes.causes = None
+	return product_details_dict
+
+def _get_product_page_details(product_details_dict, link, page_info=None):
+	"""Fetches the product's individual page and adds "size" and "description" to product_details_dict.
+
+	Returns product_details_dict, or an empty dictionary if the page could not be fetched or the description found.
+	This function does not touch any lxml element of the listing page so it is safe to call from worker threads.
 
+	page_info is an optional dictionary with what is known about the page from an earlier run ("size", "description",
+	"etag" and "last_modified", see get_ripe_fruits_delta_json()). If it has validators the page is requested with 
+	If-None-Match/If-Modified-Since and a "304 Not Modified" response reuses its "size" and "description". Once the 
+	details are retrieved page_info is updated with the page's current size, description and validators.
+	"""
+	headers = None
+	if page_info:
+		headers = BufferedResponse(link, 200, {'ETag': page_info.get('etag'), 'Last-Modified': page_info.get('last_modified')}, '').validators()
 	try:
-		response = requests.get(link, timeout=TIMEOUT)
+		response = fetch(link, stream=INCREMENTAL_PARSE, headers=headers)
 	except Exception as ex:
 		logging.error('Connecting to "%s" failed with:\n\t%s' %(link, ex))
+		count_failure('connection')
 		return {}
+
+	if headers and response.status_code == 304:
+		response.close()
+		product_details_dict['size'] = page_info['size']
+		product_details_dict['description'] = page_info['description']
+		return product_details_dict
 	
-	# In Python2, len(str) == the no. of bytes used to represent it, unlike in Python3 where 
-	# a str  needs to be explicitly converted to a `bytes` object using a particular encoding.
-	product_page_content = response.content
-	product_details_dict['size'] = str(len(product_page_content)/1024)+'kb'  
+	if INCREMENTAL_PARSE:
+		try:
+			with timed('incremental_parse'):
+				product_page_size, product_additional_details_dict = get_product_additional_details_dict_incremental(response.iter_content(CHUNK_SIZE))
+			count_wire_bytes(response)
+		except Exception as ex:
+			response.close()
+			logging.error('Reading "%s" failed with:\n\t%s' %(link, ex))
+			count_failure('read')
+			return {}
+	else:
+		# In Python2, len(str) == the no. of bytes used to represent it, unlike in Python3 where 
+		# a str  needs to be explicitly converted to a `bytes` object using a particular encoding.
+		product_page_content = response.content
+		product_page_size = len(product_page_content)
+		product_additional_details_dict = extract_product_additional_details_dict(product_page_content)
+	product_details_dict['size'] = str(product_page_size/1024)+'kb'  
+	count('bytes.product_pages', product_page_size)
 
-	product_additional_details_dict = get_product_additional_details_dict(product_page_content)
 	description = product_additional_details_dict.get('description')
 	if description is None:
 		logging.error('Could not get "description" for product')
+		count_failure('description')
 		return {}
 	product_details_dict['description'] = description
+
+	if page_info is not None:
+		page_info.update({'size': product_details_dict['size'], 'description': description, 
+						  'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')})
 	
 	return product_details_dict
 
+def extract_product_additional_details_dict(product_page_content):
+	"""Returns get_product_additional_details_dict() for the markup of a product's page, parsed by the parse pool if 
+	there is one (see configure_parse_pool()), or the copy kept by the extraction memo if the same markup was parsed 
+	already (see ExtractionMemo).
+	"""
+	extraction_memo = _extraction_memo
+	if extraction_memo is not None:
+		key = extraction_memo.key(product_page_content)
+		product_additional_details_dict = extraction_memo.get(key)
+		if product_additional_details_dict is not None:
+			return product_additional_details_dict
+
+	parse_pool = _parse_pool
+	if parse_pool is None:
+		product_additional_details_dict = get_product_additional_details_dict(product_page_content)
+	else:
+		with timed('parse'):
+			description, = parse_pool.apply(parse_product_page_fields, (product_page_content,))
+		product_additional_details_dict = {'description': description} if description is not None else {}
+
+	if extraction_memo is not None and product_additional_details_dict:  # failures are logged again each time
+		extraction_memo.put(key, product_additional_details_dict)
+	return product_additional_details_dict
+
+def configure_journal(path=None, resume=False):
+	"""Starts journaling the products fetched by get_product_page_details() to the file at path (see Journal), after 
+	loading the products already in it if resume is True, or stops journaling if path is None.
+
+	The previous journal (if any) is closed. Returns the Journal in use, or None.
+	"""
+	global _journal
+	journal, _journal = _journal, None
+	if journal is not None:
+		journal.close()
+	if path is not None:
+		_journal = Journal(path, resume)
+	return _journal
+
+class Journal(object):
+	"""Append-only journal of fetched products, one JSON object per line written (and flushed) as soon as each 
+	product is done, by the URL of its page:
+		{"url": "http://.../apricots.html", "product": {"description": "Apricots", "size": "38kb", ...}}
+		{"url": "http://.../kiwi.html", "failed": ["connection.ConnectionError", "connection"]}
+	"failed" lists the causes of the failure, as counted in the metrics (see count_failure()).
+
+	With resume the journal at path is loaded first and appended to, the products in it are returned by get() so they
+	are not fetched again while failed products are retried. A line cut short by a crash is dropped. Otherwise any
+	journal at path is replaced.
+	"""
+	def __init__(self, path, resume=False):
+		self.path = path
+		self.products = {}  # URL -> product_details_dict of the products done
+		self.failed = {}  # URL -> causes, for the products which failed and were not done since
+		self._lock = threading.Lock()
+		size = None
+		if resume and os.path.exists(path):
+			size = self._load()
+		self._file = open(path, 'ab' if resume else 'wb')
+		if size is not None:
+			self._file.truncate(size)  # drops what is left of a line cut short, so it does not swallow the next one
+
+	def _load(self):
+		"""Loads the journal, returns the size of its complete lines."""
+		size = 0
+		with open(self.path, 'rb') as f:
+			for line in f:
+				try:
+					if not line.endswith('\n'):
+						raise ValueError('no end of line')
+					entry = json.loads(line)
+				except ValueError:
+					logging.warn('Ignoring a line cut short in the journal "%s"' % self.path)
+					break
+				size += len(line)
+				if 'product' in entry:
+					self.products[entry['url']] = entry['product']
+					self.failed.pop(entry['url'], None)
+				else:
+					self.failed[entry['url']] = entry['failed']
+		logging.info('Resuming from "%s": %s products done, %s failed' %(self.path, len(self.products), len(self.failed)))
+		return size
+
+	def get(self, url):
+		"""Returns a copy of the product_details_dict recorded for url, or None if it was not recorded as done."""
+		with self._lock:
+			product_details_dict = self.products.get(url)
+		return dict(product_details_dict) if product_details_dict is not None else None
+
+	def record(self, url, product_details_dict, failure_causes=()):
+		"""Appends product_details_dict (or, if it is empty, the failure_causes) for url to the journal."""
+		if product_details_dict:
+			entry = {'url': url, 'product': product_details_dict}
+		else:
+			entry = {'url': url, 'failed': list(failure_causes)}
+		line = json.dumps(entry, sort_keys=True) + '\n'
+		with self._lock:
+			if product_details_dict:
+				self.products[url] = dict(product_details_dict)
+				self.failed.pop(url, None)
+			else:
+				self.failed[url] = entry['failed']
+			self._file.write(line)
+			self._file.flush()
+			if JOURNAL_FSYNC:
+				os.fsync(self._file.fileno())
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+def start_run():
+	"""Called at the start of each run (e.g. by get_ripe_fruits_store() or crawl()), so that nothing extracted by an 
+	earlier run in the same process (e.g. in daemon mode or the benchmark's runs) is reused: pages are parsed once per 
+	run, and a page whose markup did not change is parsed again by the next run.
+	"""
+	extraction_memo = _extraction_memo
+	if extraction_memo is not None:
+		extraction_memo.clear()
+
+def configure_extraction_memo(max_entries=EXTRACTION_MEMO_SIZE):
+	"""Replaces the extraction memo with an empty one of max_entries entries, or disables it if max_entries is 0.
+
+	Returns the ExtractionMemo in use, or None.
+	"""
+	global _extraction_memo
+	_extraction_memo = ExtractionMemo(max_entries) if max_entries > 0 else None
+	return _extraction_memo
+
+class ExtractionMemo(object):
+	"""Thread-safe LRU map of the SHA-1 of a product page's markup -> the product_additional_details_dict extracted 
+	from it, with at most max_entries entries.
+
+	Lookups are counted in hits and misses (and as "extraction_memo.hits"/"extraction_memo.misses" in the metrics).
+	"""
+	def __init__(self, max_entries=EXTRACTION_MEMO_SIZE):
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def key(self, product_page_content):
+		return hashlib.sha1(product_page_content).digest()
+
+	def get(self, key):
+		"""Returns a copy of the product_additional_details_dict stored for key, or None."""
+		with self._lock:
+			product_additional_details_dict = self._entries.pop(key, None)
+			if product_additional_details_dict is None:
+				self.misses += 1
+			else:
+				self._entries[key] = product_additional_details_dict  # most recently used
+				self.hits += 1
+		count('extraction_memo.misses' if product_additional_details_dict is None else 'extraction_memo.hits')
+		return dict(product_additional_details_dict) if product_additional_details_dict is not None else None
+
+	def clear(self):
+		"""Forgets every entry, hits and misses are still counted from where they were."""
+		with self._lock:
+			self._entries.clear()
+
+	def put(self, key, product_additional_details_dict):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = dict(product_additional_details_dict)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+
+_PATH_SAFE_CHARACTERS = "/%;:@&=+$,!~*'()"  # left as they are in a path, with the existing percent-encoding
+_PERCENT_ESCAPE = re.compile(r'%[0-9a-fA-F]{2}')
+
+def canonicalize_url(url):
+	"""Returns the canonical form of an absolute http(s) url so that URLs of the same page compare equal: the scheme 
+	and host in lower case, without the default port, the fragment and the TRACKING_QUERY_PARAMS, with the remaining 
+	query parameters sorted. Other URLs are returned unchanged.
+
+	Characters which should be percent-encoded (e.g. the non-ASCII ones of a unicode url, which lxml returns for such
+	an href, are encoded as UTF-8) are percent-encoded, in upper case, so a URL has the same canonical form whichever
+	way it was written. Query parameters without "=" are kept as they are, e.g. "?flag" does not become "?flag=".
+	"""
+	encoded_url = url.encode('utf-8') if isinstance(url, unicode) else url
+	scheme, netloc, path, query, fragment = urlparse.urlsplit(encoded_url)
+	scheme = scheme.lower()
+	if scheme not in ('http', 'https') or not netloc:
+		return url
+	netloc = netloc.lower()
+	if netloc.endswith(':80' if scheme == 'http' else ':443'):
+		netloc = netloc.rsplit(':', 1)[0]
+	path = _PERCENT_ESCAPE.sub(lambda escape: escape.group().upper(), urllib.quote(path, safe=_PATH_SAFE_CHARACTERS))
+	if query:
+		params = []
+		for param in query.split('&'):
+			name, equals, value = param.partition('=')
+			name = urllib.unquote_plus(name)
+			if not name or name in TRACKING_QUERY_PARAMS or name.startswith(TRACKING_QUERY_PARAM_PREFIXES):
+				continue
+			params.append((name, equals, urllib.unquote_plus(value)))
+		query = '&'.join(urllib.quote_plus(name) + equals + urllib.quote_plus(value) for name, equals, value in sorted(params))
+	return urlparse.urlunsplit((scheme, netloc, path or '/', query, ''))
+
+def fetch(url, stream=False, headers=None):
+	"""Returns the requests.Response for url, every HTTP request made by this module goes through this function.
+
+	If stream is True the body is not downloaded up front and should be read with response.iter_content().
+	headers are extra request headers, e.g. the caller's own If-None-Match (ignored for pages in the HTTP cache).
+
+	If the HTTP cache is enabled (see configure_http_cache()) the response may instead be a BufferedResponse holding 
+	the cached page, in which case its status_code is always 200 and its content is the full cached markup.
+
+	Raises whatever the underlying session raises (e.g. on timeout), callers are expected to handle it.
+	"""
+	kwargs = {'stream': True} if stream else {}
+	if headers:
+		kwargs['headers'] = headers
+	http_cache = _http_cache
+	if http_cache is None:
+		return _session_get(url, **kwargs)
+
+	cached_response = http_cache.get(url)
+	if cached_response is None:
+		count('http_cache.misses')
+		response = _session_get(url, **kwargs)
+	elif http_cache.is_fresh(cached_response):
+		count('http_cache.fresh_hits')
+		return cached_response
+	else:
+		kwargs['headers'] = cached_response.validators()
+		response = _session_get(url, **kwargs)
+
+	if response.status_code == 304 and cached_response is not None:
+		count('http_cache.revalidated_hits')
+		response.close()
+		http_cache.refresh(url, response)
+		return cached_response
+	if cached_response is not None:
+		count('http_cache.misses')
+	if response.status_code == 200:
+		http_cache.store(url, response)  # reads the whole body, even if stream is True
+	return response
+
+def _session_get(url, **kwargs):
+	http_archive = _http_archive
+	if http_archive is not None and not http_archive.recording:
+		return http_archive.get(url)
+
+	fetch_scheduler = _fetch_scheduler
+	if fetch_scheduler is None:
+		response = _send_get(url, **kwargs)
+	else:
+		response = fetch_scheduler.get(url, _send_get, **kwargs)
+	if http_archive is not None:
+		http_archive.record(url, response)  # reads the whole body, even if stream is True
+	return response
+
+def _send_get(url, **kwargs):
+	if not METRICS_ENABLED:
+		return get_session().get(url, timeout=TIMEOUT, **kwargs)
+
+	start = time.time()
+	try:
+		response = get_session().get(url, timeout=TIMEOUT, **kwargs)
+	except Exception as ex:
+		count_failure('connection.%s' % type(ex).__name__)
+		raise
+	seconds = time.time() - start
+	# requests can't tell DNS/connect apart from waiting for the server, "request" is the time from sending the 
+	# request until the response's headers are parsed and "transfer" the time spent downloading the body after that.
+	request_seconds = min(seconds, response.elapsed.total_seconds())
+	_metrics.record('request', request_seconds)
+	if not kwargs.get('stream'):
+		_metrics.record('transfer', seconds - request_seconds)
+		count_wire_bytes(response)
+	count('responses.%s' % response.status_code)
+	return response
+
+def count_wire_bytes(response):
+	"""Counts the bytes of response's body read from the socket so far (before decompression) as "bytes.wire", and 
+	the response by its Content-Encoding, e.g. "content_encoding.gzip", for the metrics.
+
+	Should be called once the body has been read, responses which did not come from the network are not counted.
+	"""
+	if not METRICS_ENABLED:
+		return
+	raw = getattr(response, 'raw', None)
+	if raw is None or not hasattr(raw, 'tell'):
+		return
+	count('bytes.wire', raw.tell())
+	count('content_encoding.%s' % (response.headers.get('Content-Encoding') or 'identity'))
+
+def get_session():
+	"""Returns the shared requests.Session, creating it with the default pool settings on first use."""
+	with _session_lock:
+		if _session is None:
+			_set_session(_new_session(POOL_CONNECTIONS, POOL_MAXSIZE, POOL_BLOCK))
+		return _session
+
+def configure_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, pool_block=POOL_BLOCK):
+	"""Replaces the shared requests.Session with one using the given connection pool settings and returns it.
+
+	The previous session (if any) is closed, along with its keep-alive connections.
+	"""
+	with _session_lock:
+		return _set_session(_new_session(pool_connections, pool_maxsize, pool_block))
+
+def _new_session(pool_connections, pool_maxsize, pool_block):
+	session = requests.Session()
+	session.headers.update({'Accept-Encoding': ACCEPT_ENCODING})
+	adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+def _set_session(session):
+	global _session
+	if _session is not None:
+		_session.close()
+	_session = session
+	return session
+
+def configure_http_cache(directory=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES, max_age=HTTP_CACHE_MAX_AGE):
+	"""Enables the on-disk HTTP cache in directory (created if needed) or disables it if directory is None.
+
+	Returns the HttpCache in use, or None.
+	"""
+	global _http_cache
+	_http_cache = HttpCache(directory, max_bytes, max_age) if directory is not None else None
+	return _http_cache
+
+class BufferedResponse(object):
+	"""A minimal stand-in for requests.Response for a page whose markup is already in memory (e.g. from HttpCache).
+
+	Only the attributes this module uses are provided: url, status_code, headers, content, iter_content() and close().
+	"""
+	def __init__(self, url, status_code, headers, content):
+		self.url = url
+		self.status_code = status_code
+		self.headers = headers
+		self.content = content
+
+	def iter_content(self, chunk_size=1):
+		for i in xrange(0, len(self.content), chunk_size):
+			yield self.content[i:i+chunk_size]
+
+	def close(self):
+		pass
+
+	def validators(self):
+		"""Returns the conditional request headers (If-None-Match/If-Modified-Since) to revalidate this response."""
+		validators = {}
+		if self.headers.get('ETag'):
+			validators['If-None-Match'] = self.headers['ETag']
+		if self.headers.get('Last-Modified'):
+			validators['If-Modified-Since'] = self.headers['Last-Modified']
+		return validators
+
+class HttpCache(object):
+	"""Persistent cache of page markup along with the ETag and Last-Modified headers it was served with.
+
+	Each page is stored as two files named after the SHA-1 of its URL: "<sha1>.body" holds the markup and "<sha1>.json" 
+	holds the URL, the validators and the times the page was stored/last used. When the total size of the stored markup 
+	goes above max_bytes the least recently used pages are evicted. Pages stored less than max_age seconds ago are 
+	considered fresh and are used without contacting the server.
+
+	Files are written to a temporary name and then renamed so a crash never leaves a half written page behind.
+	"""
+	def __init__(self, directory, max_bytes=HTTP_CACHE_MAX_BYTES, max_age=HTTP_CACHE_MAX_AGE):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self._lock = threading.Lock()
+		self._entries = {}  # sha1 -> the contents of "<sha1>.json"
+		self._total_bytes = 0
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._load_entries()
+
+	def get(self, url):
+		"""Returns the cached page for url as a BufferedResponse, or None if url is not cached."""
+		key = self._key(url)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+			entry['used_at'] = time.time()
+			self._write_entry(key, entry)
+		try:
+			with open(self._path(key, 'body'), 'rb') as f:
+				content = f.read()
+		except IOError:  # evicted by another thread in the meantime
+			return None
+		headers = {'ETag': entry['etag'], 'Last-Modified': entry['last_modified']}
+		response = BufferedResponse(url, 200, headers, content)
+		response.stored_at = entry['stored_at']
+		return response
+
+	def is_fresh(self, cached_response):
+		return time.time() - cached_response.stored_at < self.max_age
+
+	def store(self, url, response):
+		"""Stores response (a "200 OK" requests.Response for url) unless it has neither an ETag nor Last-Modified 
+		header (it could never be revalidated) and max_age is 0 (it would never be fresh).
+		"""
+		etag = response.headers.get('ETag')
+		last_modified = response.headers.get('Last-Modified')
+		if etag is None and last_modified is None and self.max_age <= 0:
+			return
+		content = response.content
+		key = self._key(url)
+		now = time.time()
+		entry = {'url': url, 'etag': etag, 'last_modified': last_modified, 'size': len(content), 'stored_at': now, 'used_at': now}
+		with self._lock:
+			self._write_file(self._path(key, 'body'), content)
+			self._write_entry(key, entry)
+			previous_entry = self._entries.get(key)
+			if previous_entry is not None:
+				self._total_bytes -= previous_entry['size']
+			self._entries[key] = entry
+			self._total_bytes += entry['size']
+			self._evict()
+
+	def refresh(self, url, response):
+		"""Marks the cached page for url as just revalidated by response (a "304 Not Modified" requests.Response)."""
+		key = self._key(url)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return
+			entry['stored_at'] = entry['used_at'] = time.time()
+			# A 304 response may carry updated validators.
+			entry['etag'] = response.headers.get('ETag') or entry['etag']
+			entry['last_modified'] = response.headers.get('Last-Modified') or entry['last_modified']
+			self._write_entry(key, entry)
+
+	def _evict(self):
+		if self._total_bytes <= self.max_bytes:
+			return
+		for key, entry in sorted(self._entries.items(), key=lambda item: item[1]['used_at']):
+			for extension in ('json', 'body'):
+				try:
+					os.remove(self._path(key, extension))
+				except OSError:
+					pass
+			del self._entries[key]
+			self._total_bytes -= entry['size']
+			if self._total_bytes <= self.max_bytes:
+				return
+
+	def _load_entries(self):
+		for filename in os.listdir(self.directory):
+			key, extension = os.path.splitext(filename)
+			if extension != '.json':
+				continue
+			try:
+				with open(self._path(key, 'json'), 'rb') as f:
+					entry = json.load(f)
+				assert os.path.getsize(self._path(key, 'body')) == entry['size']
+			except (IOError, OSError, ValueError, KeyError, AssertionError):
+				logging.warn('Ignoring corrupt HTTP cache entry "%s"' % filename)
+				continue
+			self._entries[key] = entry
+			self._total_bytes += entry['size']
+		self._evict()
+
+	def _write_entry(self, key, entry):
+		self._write_file(self._path(key, 'json'), json.dumps(entry))
+
+	def _write_file(self, path, content):
+		tmp_path = '%s.%s.tmp' % (path, threading.current_thread().ident)
+		with open(tmp_path, 'wb') as f:
+			f.write(content)
+		os.rename(tmp_path, path)
+
+	def _path(self, key, extension):
+		return os.path.join(self.directory, '%s.%s' % (key, extension))
+
+	@staticmethod
+	def _key(url):
+		if isinstance(url, unicode):
+			url = url.encode('utf-8')
+		return hashlib.sha1(url).hexdigest()
+
+def configure_http_archive(path=None, record=False):
+	"""Starts recording the responses to the HTTP archive at path (replacing any archive there) if record is True, or 
+	replaying them from it otherwise (see HttpArchive), or stops using an archive if path is None.
+
+	The previous archive (if any) is closed. Returns the HttpArchive in use, or None.
+	"""
+	global _http_archive
+	http_archive, _http_archive = _http_archive, None
+	if http_archive is not None:
+		http_archive.close()
+	if path is not None:
+		_http_archive = HttpArchive(path, record)
+	return _http_archive
+
+class HttpArchive(object):
+	"""Single file archive of HTTP responses by the URL they were requested with, written while recording and then 
+	memory-mapped to replay them.
+
+	The file starts with the _MAGIC line, followed by one record per response: a _RECORD header (status code and the 
+	lengths of the three fields) then the URL, the headers as JSON and the body. Bodies are stored decoded, so 
+	Content-Encoding, Content-Length and Transfer-Encoding are not kept. Closing the archive appends an index, the 
+	URLs and the offsets of their records as JSON, then a _TRAILER with the index's offset. If the URL was requested 
+	more than once its last response is replayed.
+
+	An archive without a trailer (the recording process died) is replayed by scanning its records instead, up to the 
+	first one cut short. Replaying only copies the body of each response out of the mapping, so once the file is in 
+	the OS's page cache a run reads its pages at memory speed.
+	"""
+	_MAGIC = 'sainsburys-http-archive 1\n'
+	_RECORD = struct.Struct('<HIII')  # status code, URL, headers and body lengths
+	_TRAILER = struct.Struct('<Q8s')  # offset of the index, "HAINDEX1"
+	_TRAILER_MAGIC = 'HAINDEX1'
+	_DROPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+	def __init__(self, path, record=False):
+		self.path = path
+		self.recording = record
+		self.offsets = OrderedDict()  # URL -> offset of its last record, in the order the URLs were first requested
+		self._lock = threading.Lock()
+		self._map = None
+		if record:
+			self._file = open(path, 'wb')
+			self._file.write(self._MAGIC)
+			return
+
+		self._file = open(path, 'rb')
+		if self._file.read(len(self._MAGIC)) != self._MAGIC:
+			self._file.close()
+			raise ValueError('"%s" is not an HTTP archive' % path)
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		if not self._load_index():
+			logging.warn('The HTTP archive "%s" has no index, scanning it' % path)
+			self._scan()
+
+	def record(self, url, response):
+		"""Appends response (a requests.Response for url) to the archive."""
+		content = response.content
+		headers = json.dumps(dict((name, value) for name, value in response.headers.items() if name.lower() not in self._DROPPED_HEADERS))
+		url_bytes = url.encode('utf-8') if isinstance(url, unicode) else url
+		with self._lock:
+			offset = self._file.tell()
+			self._file.write(self._RECORD.pack(response.status_code, len(url_bytes), len(headers), len(content)))
+			self._file.write(url_bytes)
+			self._file.write(headers)
+			self._file.write(content)
+			self.offsets[url_bytes] = offset
+		count('http_archive.recorded')
+
+	def get(self, url):
+		"""Returns the response recorded for url as a BufferedResponse, raises FetchError if there is none."""
+		offset = self.offsets.get(url.encode('utf-8') if isinstance(url, unicode) else url)
+		if offset is None:
+			count('http_archive.misses')
+			raise FetchError('"%s" is not in the HTTP archive "%s"' %(url, self.path))
+		status_code, url_length, headers_length, content_length = self._RECORD.unpack_from(self._map, offset)
+		start = offset + self._RECORD.size + url_length
+		headers = json.loads(self._map[start:start + headers_length])
+		start += headers_length
+		count('http_archive.replayed')
+		return BufferedResponse(url, status_code, headers, self._map[start:start + content_length])
+
+	def close(self):
+		with self._lock:
+			if self.recording and not self._file.closed:
+				index_offset = self._file.tell()
+				self._file.write(json.dumps(self.offsets.items()))
+				self._file.write(self._TRAILER.pack(index_offset, self._TRAILER_MAGIC))
+			if self._map is not None:
+				self._map.close()
+				self._map = None
+			self._file.close()
+
+	def _load_index(self):
+		size = len(self._map)
+		if size < len(self._MAGIC) + self._TRAILER.size:
+			return False
+		index_offset, trailer_magic = self._TRAILER.unpack_from(self._map, size - self._TRAILER.size)
+		if trailer_magic != self._TRAILER_MAGIC or not len(self._MAGIC) <= index_offset <= size - self._TRAILER.size:
+			return False
+		try:
+			index = json.loads(self._map[index_offset:size - self._TRAILER.size])
+		except ValueError:
+			return False
+		self.offsets = OrderedDict((url.encode('utf-8'), offset) for url, offset in index)
+		return True
+
+	def _scan(self):
+		offset = len(self._MAGIC)
+		size = len(self._map)
+		while offset + self._RECORD.size <= size:
+			_, url_length, headers_length, content_length = self._RECORD.unpack_from(self._map, offset)
+			end = offset + self._RECORD.size + url_length + headers_length + content_length
+			if end > size:
+				break
+			url_start = offset + self._RECORD.size
+			self.offsets[self._map[url_start:url_start + url_length]] = offset
+			offset = end
+		if offset != size:
+			logging.warn('Ignoring a response cut short in the HTTP archive "%s"' % self.path)
+
+def configure_fetch_scheduler(enabled=True, retries=RETRIES, rate_limit=RATE_LIMIT, rate_burst=RATE_BURST, 
+							  initial_concurrency=INITIAL_CONCURRENCY, latency_tolerance=LATENCY_TOLERANCE):
+	"""Enables the fetch scheduler with the given settings (see FetchScheduler), or disables it if enabled is False.
+
+	Returns the FetchScheduler in use, or None.
+	"""
+	global _fetch_scheduler
+	_fetch_scheduler = FetchScheduler(retries, rate_limit, rate_burst, initial_concurrency, latency_tolerance) if enabled else None
+	return _fetch_scheduler
+
+class FetchError(Exception):
+	"""Raised by the fetch scheduler when a request still fails with one of the RETRY_STATUSES after all its retries,
+	and when replaying an HTTP archive which does not hold the requested URL.
+	"""
+
+class FetchScheduler(object):
+	"""Sends requests on behalf of fetch(), keeping the following per host:
+		- A token bucket limiting the requests to rate_limit per second (in bursts of at most rate_burst).
+		- A concurrency limit (see _ConcurrencyLimit) starting at initial_concurrency, which grows additively while the 
+		  responses are healthy and is halved when they are not (AIMD). A response is not healthy if it failed, has one 
+		  of the RETRY_STATUSES or took over latency_tolerance times as long as the fastest response from the host.
+	Failed requests are retried up to retries times, after a random wait between 0 and BACKOFF_BASE * 2**n seconds 
+	(capped at BACKOFF_MAX) for the n-th retry or after the time given by the response's Retry-After header.
+	"""
+	def __init__(self, retries=RETRIES, rate_limit=RATE_LIMIT, rate_burst=RATE_BURST, initial_concurrency=INITIAL_CONCURRENCY,
+				 latency_tolerance=LATENCY_TOLERANCE):
+		self.retries = retries
+		self.rate_limit = rate_limit
+		self.rate_burst = rate_burst
+		self.initial_concurrency = initial_concurrency
+		self.latency_tolerance = latency_tolerance
+		self._lock = threading.Lock()
+		self._hosts = {}  # host -> (_TokenBucket or None, _ConcurrencyLimit)
+
+	def get(self, url, send, **kwargs):
+		"""Returns send(url, **kwargs) (a requests.Response), sent when the host's rate and concurrency limits allow it.
+
+		Raises the last exception raised by send() or FetchError if all the attempts failed.
+		"""
+		token_bucket, concurrency_limit = self._get_host(urlparse.urlsplit(url).netloc)
+		for attempt in xrange(self.retries + 1):
+			if token_bucket is not None:
+				token_bucket.take()
+			concurrency_limit.acquire()
+			start = time.time()
+			response = error = None
+			try:
+				response = send(url, **kwargs)
+			except Exception as ex:
+				error = ex
+			failed = error is not None or response.status_code in RETRY_STATUSES
+			concurrency_limit.release(start, time.time() - start, failed)
+			if not failed:
+				return response
+
+			if attempt == self.retries:
+				break
+			delay = self._get_retry_delay(attempt, response)
+			logging.info('Retrying "%s" in %.2fs (%s)' %(url, delay, error or 'status %s' % response.status_code))
+			count('retries')
+			if response is not None:
+				response.close()
+			time.sleep(delay)
+
+		if error is not None:
+			raise error
+		raise FetchError('"%s" still failed with status %s after %s retries' %(url, response.status_code, self.retries))
+
+	def get_concurrency(self, host):
+		"""Returns the current concurrency limit for host."""
+		return self._get_host(host)[1].limit
+
+	def _get_host(self, host):
+		with self._lock:
+			if host not in self._hosts:
+				token_bucket = _TokenBucket(self.rate_limit, self.rate_burst) if self.rate_limit else None
+				self._hosts[host] = (token_bucket, _ConcurrencyLimit(self.initial_concurrency, self.latency_tolerance))
+			return self._hosts[host]
+
+	def _get_retry_delay(self, attempt, response):
+		if response is not None:
+			try:
+				return min(BACKOFF_MAX, max(0, int(response.headers.get('Retry-After'))))
+			except (TypeError, ValueError):  # no header or an HTTP date
+				pass
+		return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+class _TokenBucket(object):
+	def __init__(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated_at = time.time()
+		self._lock = threading.Lock()
+
+	def take(self):
+		"""Blocks until a token is available and takes it."""
+		while True:
+			with self._lock:
+				now = time.time()
+				self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+				self.updated_at = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+class _ConcurrencyLimit(object):
+	"""AIMD limit on the no. of requests in flight to a host.
+
+	Each healthy response adds 1/limit to the limit (so it grows by ~1 per round trip's worth of responses), an 
+	unhealthy one halves it, but only once for all the requests which were already in flight when it was last halved.
+	"""
+	def __init__(self, initial_limit, latency_tolerance):
+		self.limit = float(initial_limit)
+		self.latency_tolerance = latency_tolerance
+		self.in_flight = 0
+		self.fastest = None  # seconds, fastest healthy response so far
+		self.decreased_at = None  # time the limit was last halved
+		self._condition = threading.Condition()
+
+	def acquire(self):
+		with self._condition:
+			while self.in_flight >= int(self.limit):
+				self._condition.wait()
+			self.in_flight += 1
+
+	def release(self, start, seconds, failed):
+		with self._condition:
+			self.in_flight -= 1
+			if not failed and (self.fastest is None or seconds < self.fastest):
+				self.fastest = seconds
+			if failed or self.fastest is not None and seconds > self.fastest * self.latency_tolerance:
+				if self.decreased_at is None or start > self.decreased_at:
+					self.limit = max(1.0, self.limit / 2)
+					self.decreased_at = time.time()
+			else:
+				self.limit += 1 / self.limit
+			self._condition.notify_all()
+
+def load_selectors(path=SELECTORS_FILE):
+	"""Compiles DEFAULT_SELECTORS, overridden by the selectors in the JSON file at path (if any), into the registry 
+	used by select().
+
+	Raises ValueError if the file has a field which is not in DEFAULT_SELECTORS and etree.XPathSyntaxError if any 
+	expression is invalid, so a broken selector file is noticed up front rather than once per product.
+	"""
+	global _selectors, _overridden_selectors
+	selectors = dict(DEFAULT_SELECTORS)
+	if path is not None:
+		with open(path) as f:
+			overrides = json.load(f)
+		for field, expressions in overrides.items():
+			if field not in DEFAULT_SELECTORS:
+				raise ValueError('Unknown selector field "%s" in "%s"' % (field, path))
+			selectors[field] = [expressions] if isinstance(expressions, basestring) else expressions
+	_selectors = dict((field, [etree.XPath(expression) for expression in expressions]) for field, expressions in selectors.items())
+	_overridden_selectors = set(field for field in selectors if selectors[field] != DEFAULT_SELECTORS[field])
+
+def select(field, node):
+	"""Returns the list of elements found by evaluating the selectors for field on node (an lxml element or tree).
+
+	The field's selectors are tried in order and the result of the first one which finds something is returned, 
+	an empty list is returned if none of them do.
+	"""
+	with timed('xpath'):
+		for xpath in _selectors[field]:
+			result = xpath(node)
+			if result:
+				return result
+		return []
+
 def get_product_unit_price(li):
 	"""Returns the product's unit price as a str (e.g. '3.50') or None if it couldn't retrieve it.
 
 	Retrieving the product's unit price is tricky since the <div> element we need has a dynamically generated id 
-	attribute so it is not possible to reference it directly using a single XPath expression, we need to do some work.
+	attribute so it is not possible to reference it directly using a single XPath expression, we need to do some work
+	(see get_product_add_item_div()).
+	"""
+	addItemDiv = get_product_add_item_div(li)
+	if addItemDiv is None:
+		return None
+
+	unit_price_text = select('unit_price', addItemDiv)
+	try:
+		unit_price_text = unit_price_text[0].text
+	except IndexError:
+		logging.error('XPath expression failed')
+		count_failure('xpath')
+		return None
+
+	unit_price = unit_price_text.strip().replace('&pound', '')
+	if not unit_price.replace('.', '').isdigit():
+		logging.error('"%s" is not a valid price' % unit_price)
+		count_failure('invalid_price')
+		return None
+
+	return unit_price
+
+def get_product_id(li):
+	"""Returns the product's id as a str (e.g. '149117' for <div id="addItem_149117">) or None if it couldn't retrieve it.
+
+	Unlike the product's title or link, the id does not change when the product is renamed so it is used to recognise
+	products across runs (see get_ripe_fruits_delta_json()).
 	"""
-	pricingAndTrolleyOptionsDiv = li.xpath('''div[@class='product ']/
-												div[@class='productInner']/
-													div[@class='addToTrolleytabBox']/
-														div[@class='addToTrolleytabContainer addItemBorderTop']/
-															div[@class='pricingAndTrolleyOptions']''')
+	addItemDiv = get_product_add_item_div(li)
+	if addItemDiv is None:
+		return None
+
+	add_item_id = addItemDiv.get('id') or ''
+	if not add_item_id.startswith('addItem_') or not add_item_id[len('addItem_'):]:
+		logging.error('"%s" is not a valid product id' % add_item_id)
+		count_failure('invalid_product_id')
+		return None
+
+	return add_item_id[len('addItem_'):]
+
+def get_product_add_item_div(li):
+	"""Returns the product's <div id="addItem_****"> element, which holds its price, or None if it couldn't retrieve it.
+
+	The <div> element has a dynamically generated id attribute so it is not possible to reference it directly using 
+	a single XPath expression, we need to get to its parent and then do some work.
+	"""
+	pricingAndTrolleyOptionsDiv = select('pricing_and_trolley_options', li)
 	try:
 		pricingAndTrolleyOptionsDiv = pricingAndTrolleyOptionsDiv[0]
 	except IndexError:
 		logging.error('XPath expression failed')
+		count_failure('xpath')
 		return None
 
 	# Below, we get pricingAndTrolleyOptionsDiv's child elements and filter out the comments to get addItemDiv.
@@ -161,39 +2100,23 @@ def get_product_unit_price(li):
 		assert(addItemDiv.get('class') == 'priceTab activeContainer priceTabContainer')  # just to make sure it's the one
 	except AssertionError:
 		logging.error('XPath expression failed')
+		count_failure('xpath')
 		return None
 
-	unit_price_text = addItemDiv.xpath('''div[@class='pricing']/
-											p[@class='pricePerUnit']''')
-	try:
-		unit_price_text = unit_price_text[0].text
-	except IndexError:
-		logging.error('XPath expression failed')
-		return None
-
-	unit_price = unit_price_text.strip().replace('&pound', '')
-	if not unit_price.replace('.', '').isdigit():
-		logging.error('"%s" is not a valid price' % unit_price)
-		return None
-
-	return unit_price
+	return addItemDiv
 
 def get_product_link_element(li): 
 	"""Returns the <a> element which contains the product's name and the link to the product's individual page.
 	
 	Returns None if the <a> element could not be retrieved.
 	"""
-	a = li.xpath('''div[@class='product ']/
-						div[@class='productInner']/
-							div[@class='productInfoWrapper']/
-								div[@class='productInfo']/
-									h3/
-										a''')
+	a = select('product_link', li)
 	try:
 		a = a[0]
 		return a
 	except IndexError:
 		logging.error('XPath expression failed')
+		count_failure('xpath')
 		return None
 
 def get_product_additional_details_dict(product_page_content):
@@ -207,36 +2130,576 @@ def get_product_additional_details_dict(product_page_content):
 	more keys are required.
 
 	This function is guaranteed to return at least an empty dictionary if details could not be retrieved.
+
+	With FAST_EXTRACT the page is only parsed if get_product_description_fast() cannot find the description.
 	"""
+	if FAST_EXTRACT:
+		with timed('fast_extract'):
+			description = get_product_description_fast(product_page_content)
+		if description is None:
+			count('fast_extract.fallbacks')
+		elif not VERIFY_FAST_EXTRACT:
+			count('fast_extract.hits')
+			return {'description': description}
+		else:
+			count('fast_extract.hits')
+			product_additional_details_dict = _get_product_additional_details_dict(product_page_content)
+			if product_additional_details_dict.get('description') != description:
+				logging.warn('Fast extraction found the description %r instead of %r' %(description, product_additional_details_dict.get('description')))
+				count('fast_extract.mismatches')
+			return product_additional_details_dict
+
+	return _get_product_additional_details_dict(product_page_content)
 
+def _get_product_additional_details_dict(product_page_content):
 	product_additional_details_dict = {}
 
-	subtree = html.parse(StringIO(product_page_content), parser=html.HTMLParser())
-	productTextDiv = subtree.xpath('''body/
-										div[@id='page']/
-											div[@id='main']/
-												div[@id='content']/
-													div[@class='section productContent']/
-														div[@class='mainProductInfoWrapper']/
-															div[@class='mainProductInfo']/
-																div[@class='tabs']/
-																	div[@id='information']/
-																		productcontent/
-																			htmlcontent/
-																				div[@class='productText']''')
-	try:
-		productTextDiv = productTextDiv[0]
-		productNameElement = productTextDiv.xpath("p")
+	with timed('parse'):
+		subtree = html.parse(StringIO(product_page_content), parser=html.HTMLParser())
+	productTextDiv = get_product_text_div(subtree)
+	if productTextDiv is None:
+		logging.error('XPath expression failed')
+		count_failure('xpath')
+		return product_additional_details_dict
+
+	productNameElement = select('description', productTextDiv)
+	try:
 		product_additional_details_dict['description'] = productNameElement[0].text.strip()
 	except IndexError:
 		logging.error('XPath expression failed')
+		count_failure('xpath')
 
 	return product_additional_details_dict
 
-def main():
-	json_string = get_ripe_fruits_json()
-	print json_string
+_PRODUCT_TEXT_DIV = re.compile(r'<div class="productText">')
+_TAG_START = re.compile(r'</?[A-Za-z!]')  # where the parser ends a text node
+# What the "product_text" selector expects right before the <div>, with the headings product pages have before it.
+_PRODUCT_TEXT_CONTEXT = re.compile(r'<div id="information">\s*<productcontent>\s*<htmlcontent>\s*(?:<h3[^<>]*>[^<>]*</h3>\s*)*\Z')
+_CONTROL_CHARACTERS = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')  # dropped or replaced by the parser
+# Whatever comes first of a comment, a <script> or <style> element (whose contents are not markup) and "productText".
+_FAST_SCAN = re.compile(r'<!--|<([Ss][Cc][Rr][Ii][Pp][Tt]|[Ss][Tt][Yy][Ll][Ee])(?=[\s/>])|productText')
+_RAW_TEXT_END = {
+	'script': re.compile(r'</script[\s/>]', re.IGNORECASE),
+	'style': re.compile(r'</style[\s/>]', re.IGNORECASE),
+}
+
+def get_product_description_fast(product_page_content):
+	"""Returns the text of the first <p> in the first <div class="productText"> of a product's page (stripped, as 
+	get_product_additional_details_dict() returns it) by scanning the markup, without parsing it into a tree.
+
+	Returns None whenever the scan could disagree with the XPath selectors, so the caller falls back to parsing:
+		- the "product_text" or "description" selectors were overridden (see load_selectors())
+		- the first "productText" in the page outside of comments, <script> and <style> elements is not exactly 
+		  <div class="productText">, or one of these is left unterminated before it
+		- that <div> does not directly follow <div id="information"><productcontent><htmlcontent> (and headings), 
+		  e.g. it is a promotion before the description or inside a <noscript> or <textarea>
+		- the <div>'s first tag is not exactly <p>, or the <p>'s text is empty or has entities, "\r", control 
+		  characters or non-ASCII bytes (the parser decodes or drops these)
+	Only the start of the "product_text" selector's path is checked, see VERIFY_FAST_EXTRACT to compare both.
+	"""
+	if 'product_text' in _overridden_selectors or 'description' in _overridden_selectors:
+		return None
+	position = 0
+	while True:
+		match = _FAST_SCAN.search(product_page_content, position)
+		if match is None:
+			return None
+		if match.group() == 'productText':
+			break
+		if match.group(1) is None:  # a comment
+			end = product_page_content.find('-->', match.end())
+			if end < 0:
+				return None
+			position = end + len('-->')
+		else:
+			end = _RAW_TEXT_END[match.group(1).lower()].search(product_page_content, match.end())
+			if end is None:
+				return None
+			position = end.end()
+	start = match.start()
+	div = _PRODUCT_TEXT_DIV.search(product_page_content, start - len('<div class="'), start + len('productText">'))
+	if div is None:
+		return None
+	information = product_page_content.rfind('<div id="information">', 0, div.start())
+	if information < 0 or not _PRODUCT_TEXT_CONTEXT.match(product_page_content, information, div.start()):
+		return None
+
+	p = product_page_content.find('<', div.end())
+	if p < 0 or not product_page_content.startswith('<p>', p):
+		return None
+	text_start = p + len('<p>')
+	text_end = product_page_content.find('<', text_start)
+	if text_end < 0 or not _TAG_START.match(product_page_content, text_end):
+		return None
+	text = product_page_content[text_start:text_end]
+	if '&' in text or '\r' in text or _CONTROL_CHARACTERS.search(text) or not text.strip():
+		return None
+	try:
+		text.decode('ascii')
+	except UnicodeDecodeError:
+		return None
+	return text.strip()
+
+def get_product_additional_details_dict_incremental(product_page_chunks):
+	"""Same as get_product_additional_details_dict() but the product's page is fed to the parser one chunk at a time 
+	(e.g. as they are read from the socket) and returns a (no. of bytes in the page, product_additional_details_dict) tuple.
+
+	Once the description (the first <p> in <div class="productText">) has been parsed no more chunks are fed to the 
+	parser, so the rest of the page is neither parsed nor kept in memory, the chunks are only counted.
+	"""
+	product_additional_details_dict = {}
+	product_page_size = 0
+
+	parser = etree.HTMLPullParser(events=('end',), tag='p')
+	for chunk in product_page_chunks:
+		product_page_size += len(chunk)
+		if parser is None:
+			continue
+		parser.feed(chunk)
+		if _read_product_description(parser, product_additional_details_dict):
+			parser = None
+
+	if parser is not None:
+		parser.close()  # the last events may only come out once the parser knows the page is over
+		_read_product_description(parser, product_additional_details_dict)
+	if 'description' not in product_additional_details_dict:
+		logging.error('XPath expression failed')
+		count_failure('xpath')
+
+	return product_page_size, product_additional_details_dict
+
+def _read_product_description(parser, product_additional_details_dict):
+	"""Reads the <p> events of parser so far, adds the "description" to product_additional_details_dict if it is among
+	them and returns True once it is known whether the page has a description (no more chunks need to be parsed).
+	"""
+	for _, p in parser.read_events():
+		productTextDiv = p.getparent()
+		if productTextDiv is None or productTextDiv.get('class') != 'productText':
+			continue
+		# The same check as in get_product_additional_details_dict(), the path up to the <div> has been parsed already.
+		firstProductTextDiv = get_product_text_div(p.getroottree())
+		if firstProductTextDiv is not productTextDiv:
+			continue  # e.g. a <div class="productText"> before the one on the selector's path
+		if select('description', productTextDiv)[0] is p:
+			product_additional_details_dict['description'] = p.text.strip()
+		return True
+	return False
+
+def parse_product_page_fields(product_page_content):
+	"""Returns a (description,) tuple for a product's page, description being None if it could not be found.
+
+	This is what the processes of the parse pool run (see configure_parse_pool()), only the page's markup and the 
+	tuple go through the pipes between the processes.
+	"""
+	return (get_product_additional_details_dict(product_page_content).get('description'),)
+
+def configure_parse_pool(processes=PARSE_PROCESSES):
+	"""Starts a pool of processes which parse product pages (replacing the previous pool, if any) or, if processes 
+	is 0, goes back to parsing them in the threads fetching them.
+
+	Should be called before any thread is started, as the pool's processes are forked from the current one.
+	"""
+	global _parse_pool
+	parse_pool, _parse_pool = _parse_pool, None
+	if parse_pool is not None:
+		parse_pool.close()
+		parse_pool.join()
+	if processes > 0:
+		_parse_pool = multiprocessing.Pool(processes)
+	return _parse_pool
+
+def get_product_text_div(tree):
+	"""Returns the <div class="productText"> element of a product page's tree, or None if it could not be found."""
+	productTextDiv = select('product_text', tree)
+	try:
+		return productTextDiv[0]
+	except IndexError:
+		return None
+
+class Metrics(object):
+	"""Thread-safe counters and per-phase timers, see METRICS_ENABLED.
+
+	Timers keep the no. of times a phase was timed, the total and max no. of seconds spent in it and a histogram 
+	of the durations (the no. of durations in each of the TIMER_BUCKETS, each bucket counting the durations above the 
+	previous bound and up to its own) from which percentiles can be estimated.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self._counters = {}
+			self._timers = {}
+
+	def add(self, name, value=1):
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + value
+
+	def record(self, phase, seconds):
+		with self._lock:
+			timer = self._timers.get(phase)
+			if timer is None:
+				timer = self._timers[phase] = {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'buckets': [0] * len(TIMER_BUCKETS)}
+			timer['count'] += 1
+			timer['total_seconds'] += seconds
+			timer['max_seconds'] = max(timer['max_seconds'], seconds)
+			timer['buckets'][bisect.bisect_left(TIMER_BUCKETS, seconds)] += 1
+
+	def timer(self, phase):
+		return _MetricsTimer(self, phase)
+
+	def dump(self):
+		"""Returns the counters and timers as a dictionary which can be serialised to JSON."""
+		with self._lock:
+			timers = {}
+			for phase, timer in self._timers.items():
+				timers[phase] = {
+					'count': timer['count'],
+					'total_seconds': timer['total_seconds'],
+					'mean_seconds': timer['total_seconds'] / timer['count'],
+					'max_seconds': timer['max_seconds'],
+					'buckets': list(timer['buckets']),
+				}
+			return {'counters': dict(self._counters), 'timers': timers, 'timer_buckets': map(str, TIMER_BUCKETS)}
+
+class _MetricsTimer(object):
+	def __init__(self, metrics, phase):
+		self.metrics = metrics
+		self.phase = phase
+
+	def __enter__(self):
+		self.start = time.time()
+
+	def __exit__(self, *exc_info):
+		self.metrics.record(self.phase, time.time() - self.start)
+
+class _NoTimer(object):
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *exc_info):
+		pass
+
+_NO_TIMER = _NoTimer()
+_metrics = Metrics()
+
+def timed(phase):
+	"""Returns a context manager timing phase (e.g. "parse"), or one which does nothing if METRICS_ENABLED is False."""
+	if METRICS_ENABLED:
+		return _metrics.timer(phase)
+	return _NO_TIMER
+
+def count(name, value=1):
+	"""Adds value to the counter called name (e.g. "bytes.product_pages") if METRICS_ENABLED is True."""
+	if METRICS_ENABLED:
+		_metrics.add(name, value)
+
+def count_failure(cause):
+	"""Counts a failure by cause, e.g. "xpath" for the "XPath expression failed" errors."""
+	if METRICS_ENABLED:
+		_metrics.add('failures.' + cause)
+	causes = getattr(_failure_causes, 'causes', None)
+	if causes is not None:
+		causes.append(cause)
+
+def get_metrics():
+	"""Returns the metrics collected so far (see Metrics.dump()), e.g.:
+		{
+		    "counters": {"bytes.product_pages": 272006, "failures.xpath": 1, "responses.200": 8, ...},
+		    "timers": {"parse": {"count": 8, "total_seconds": 0.021, "mean_seconds": 0.0026, "max_seconds": 0.004, 
+		                         "buckets": [0, 1, 7, 0, ...]}, ...},
+		    "timer_buckets": ["0.001", "0.002", "0.005", ..., "inf"]
+		}
+
+	Work done in the parse pool's processes is only timed as a whole, as "parse", by the threads waiting for it.
+	"""
+	return _metrics.dump()
+
+def write_metrics(path):
+	"""Writes get_metrics() as a JSON string to the file at path, or to stderr if path is "-"."""
+	json_string = json.dumps(get_metrics(), indent=4, sort_keys=True)
+	if path == '-':
+		sys.stderr.write(json_string + '\n')
+		return
+	with open(path, 'w') as f:
+		f.write(json_string + '\n')
+
+class SnapshotCache(object):
+	"""Thread-safe holder of the latest and previous JSON strings produced by the daemon (see serve_snapshots())."""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._snapshots = {}  # 'latest'/'previous' -> (json_string, etag, time it was scraped at)
+		self._status = {'runs': 0, 'failed_runs': 0, 'last_run_at': None, 'last_run_seconds': None}
+
+	def update(self, json_string, started_at, seconds):
+		"""Makes json_string the latest snapshot (and the latest the previous one), unless it is empty (a failed run)."""
+		with self._lock:
+			self._status.update(runs=self._status['runs'] + 1, last_run_at=started_at, last_run_seconds=seconds)
+			if not json_string:
+				self._status['failed_runs'] += 1
+				return
+			if 'latest' in self._snapshots:
+				self._snapshots['previous'] = self._snapshots['latest']
+			self._snapshots['latest'] = (json_string, '"%s"' % hashlib.sha1(json_string).hexdigest(), started_at)
+
+	def get(self, name):
+		"""Returns the (json_string, etag, time it was scraped at) of the 'latest' or 'previous' snapshot, or None."""
+		with self._lock:
+			return self._snapshots.get(name)
+
+	def get_status(self):
+		with self._lock:
+			return dict(self._status, snapshots=dict((name, snapshot[2]) for name, snapshot in self._snapshots.items()))
+
+class SnapshotRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves the server's SnapshotCache:
+		/latest (or /): the latest JSON string, "503 Service Unavailable" until the first run succeeded
+		/previous: the JSON string before it, "404 Not Found" if there is none yet
+		/status: the no. of runs (and failed ones), when the last run started, how long it took and when each snapshot
+		         was scraped (seconds since the epoch)
+		/metrics: get_metrics()
+	Snapshots are sent with an ETag so clients polling with If-None-Match only get "304 Not Modified" if they did not change.
+	"""
+	protocol_version = 'HTTP/1.1'  # keep-alive
+	# Without these the headers and the body go out in separate small writes and delayed ACKs add ~40ms per response.
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		path = urlparse.urlsplit(self.path).path
+		if path in ('/', '/latest', '/previous'):
+			snapshot = self.server.snapshots.get('previous' if path == '/previous' else 'latest')
+			if snapshot is None:
+				self._send(404 if path == '/previous' else 503, json.dumps({'error': 'No snapshot yet'}))
+				return
+			json_string, etag, scraped_at = snapshot
+			if self.headers.get('If-None-Match') == etag:
+				self._send(304, '', etag)
+			else:
+				self._send(200, json_string, etag)
+		elif path == '/status':
+			self._send(200, json.dumps(self.server.snapshots.get_status(), indent=4, sort_keys=True))
+		elif path == '/metrics':
+			self._send(200, json.dumps(get_metrics(), indent=4, sort_keys=True))
+		else:
+			self._send(404, json.dumps({'error': 'Not found'}))
+
+	def _send(self, status, body, etag=None):
+		self.send_response(status)
+		if status != 304:
+			self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		if etag is not None:
+			self.send_header('ETag', etag)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logging.info('%s - %s' %(self.address_string(), format % args))
+
+class SnapshotServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, snapshots):
+		BaseHTTPServer.HTTPServer.__init__(self, address, SnapshotRequestHandler)
+		self.snapshots = snapshots
+
+def serve_snapshots(produce, port, host=SERVE_HOST, interval=SERVE_INTERVAL, stop=None, snapshots=None):
+	"""Daemon mode: calls produce() (which returns a JSON string, or an empty string if it failed) every interval 
+	seconds and serves the results over HTTP on host:port (see SnapshotRequestHandler) until stop (a threading.Event) 
+	is set or KeyboardInterrupt is raised.
+
+	The process, and with it the HTTP session's keep-alive connections, the compiled selectors and the parse pool, is 
+	kept between runs. interval is counted from the start of a run, a run taking longer is followed by the next at once.
+	A run which raises or fails keeps the previous snapshots.
+	"""
+	stop = stop or threading.Event()
+	snapshots = snapshots if snapshots is not None else SnapshotCache()
+	server = SnapshotServer((host, port), snapshots)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	logging.info('Serving snapshots on http://%s:%s/' % server.server_address[:2])
+	try:
+		while not stop.is_set():
+			started_at = time.time()
+			try:
+				json_string = produce()
+			except Exception as ex:
+				logging.error('Scraping failed with:\n\t%s' % ex)
+				json_string = ''
+			seconds = time.time() - started_at
+			snapshots.update(json_string, started_at, seconds)
+			stop.wait(max(0, interval - seconds))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.shutdown()
+		server.server_close()
+
+def main(argv=None):
+	global STREAM_LISTER, INCREMENTAL_PARSE, FAST_EXTRACT, VERIFY_FAST_EXTRACT, METRICS_ENABLED
+
+	parser = argparse.ArgumentParser(description='Prints a JSON string with details of the products listed on %s' % RIPE_FRUITS_URL)
+	parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS, 
+						help='max no. of product pages fetched at the same time (default: %(default)s)')
+	parser.add_argument('--pool-size', type=int, default=POOL_MAXSIZE,
+						help='max no. of keep-alive connections per host (default: %(default)s)')
+	parser.add_argument('--cache-dir', default=HTTP_CACHE_DIR,
+						help='directory of the on-disk HTTP cache, pages are only downloaded again if they changed (default: no cache)')
+	parser.add_argument('--cache-max-mb', type=int, default=HTTP_CACHE_MAX_BYTES/(1024*1024),
+						help='max size of the HTTP cache in MB (default: %(default)s)')
+	parser.add_argument('--cache-max-age', type=int, default=HTTP_CACHE_MAX_AGE,
+						help='seconds during which cached pages are used without checking if they changed (default: %(default)s)')
+	parser.add_argument('--parse-processes', type=int, default=PARSE_PROCESSES,
+						help='no. of processes parsing product pages, e.g. the no. of CPU cores (default: %(default)s, parse them in the fetching threads)')
+	parser.add_argument('--memo-size', type=int, default=EXTRACTION_MEMO_SIZE,
+						help='no. of distinct product pages whose extracted details are remembered, 0 to parse every page (default: %(default)s)')
+	parser.add_argument('--selectors', default=SELECTORS_FILE,
+						help='JSON file overriding the XPath selectors used to locate elements on the webpages')
+	parser.add_argument('--stream-lister', action='store_true', default=STREAM_LISTER,
+						help='parse the lister page while it is downloaded and request each product page as soon as it is listed')
+	parser.add_argument('--incremental', action='store_true', default=INCREMENTAL_PARSE,
+						help='parse product pages while they are downloaded and stop parsing once the description is found')
+	parser.add_argument('--fast-extract', action='store_true', default=FAST_EXTRACT,
+						help='scan product pages for the description and only parse them when the scan is not sure')
+	parser.add_argument('--verify-fast-extract', action='store_true', default=VERIFY_FAST_EXTRACT,
+						help='like --fast-extract but also parse every page and log where the two disagree')
+	parser.add_argument('--crawl', nargs='+', metavar='URL',
+						help='crawl these lister pages (and their following pages) instead of only %s' % RIPE_FRUITS_URL)
+	parser.add_argument('--ndjson', action='store_true',
+						help='print one JSON object per line as soon as each product is retrieved, the last line holds the total')
+	parser.add_argument('--delta', metavar='SNAPSHOT',
+						help='only print the products added, removed or changed since the snapshot saved in this file by the previous run')
+	parser.add_argument('--serve', type=int, metavar='PORT',
+						help='daemon mode, scrape every --interval seconds and serve the latest JSON string on http://%s:PORT/' % SERVE_HOST)
+	parser.add_argument('--interval', type=float, default=SERVE_INTERVAL, help='seconds between scrapes with --serve (default: %(default)s)')
+	parser.add_argument('--shard-db', metavar='DB',
+						help='sharded mode, the SQLite work queue shared by the shard workers. Alone, prints the merged results')
+	parser.add_argument('--shards', type=int, metavar='N',
+						help='with --shard-db, queue the products in N shards, fetch them in N local processes and print the merged results')
+	parser.add_argument('--plan-only', action='store_true', help='with --shards, only queue the products (for workers on other machines)')
+	parser.add_argument('--shard', type=int, metavar='I', help='with --shard-db, fetch the products queued in shard I')
+	parser.add_argument('--journal', metavar='FILE',
+						help='record every product in this file as soon as its page is fetched, see --resume')
+	parser.add_argument('--resume', action='store_true',
+						help='with --journal, do not fetch again the pages of the products already in the journal')
+	parser.add_argument('--record', metavar='FILE',
+						help='save every response received in this HTTP archive, to scrape the same pages again with --replay')
+	parser.add_argument('--replay', metavar='FILE',
+						help='serve every request from this HTTP archive saved by --record instead of sending it')
+	parser.add_argument('--metrics', metavar='FILE',
+						help='write per-phase timings, byte counts and failures by cause as JSON to this file ("-" for stderr)')
+	parser.add_argument('--profile', metavar='FILE',
+						help='profile the run with cProfile (main thread only) and save the stats to this file for pstats')
+	parser.add_argument('--adaptive', action='store_true',
+						help='retry failed requests with backoff and adapt the no. of requests in flight to how the host copes')
+	parser.add_argument('--retries', type=int, default=RETRIES, help='no. of retries with --adaptive (default: %(default)s)')
+	parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT, 
+						help='max requests per second to each host with --adaptive (default: no limit)')
+	parser.add_argument('--csv', metavar='FILE', help='also write the products to this file as CSV')
+	parser.add_argument('--columns', metavar='FILE', 
+						help='also write the products to this file in a compact binary column by column format (see ProductStore)')
+	args = parser.parse_args(argv)
+
+	STREAM_LISTER = args.stream_lister
+	INCREMENTAL_PARSE = args.incremental
+	FAST_EXTRACT = args.fast_extract or args.verify_fast_extract
+	VERIFY_FAST_EXTRACT = args.verify_fast_extract
+	load_selectors(args.selectors)
+	configure_parse_pool(args.parse_processes)
+	configure_extraction_memo(args.memo_size)
+	configure_session(pool_maxsize=args.pool_size)
+	configure_http_cache(args.cache_dir, args.cache_max_mb*1024*1024, args.cache_max_age)
+	configure_fetch_scheduler(args.adaptive, retries=args.retries, rate_limit=args.rate_limit)
+
+	if sum(map(bool, [args.ndjson, args.crawl, args.delta])) > 1:
+		parser.error('only one of --ndjson, --crawl and --delta can be used')
+	if (args.csv or args.columns) and (args.ndjson or args.crawl or args.delta):
+		parser.error('--csv and --columns cannot be used with --ndjson, --crawl or --delta')
+	if args.serve is not None and args.ndjson:
+		parser.error('--serve cannot be used with --ndjson')
+	if (args.shards is not None or args.shard is not None or args.plan_only) and not args.shard_db:
+		parser.error('--shards, --shard and --plan-only need --shard-db')
+	if args.shard_db and (args.ndjson or args.delta or args.csv or args.columns or args.serve is not None):
+		parser.error('--shard-db cannot be used with --ndjson, --delta, --csv, --columns or --serve')
+	if args.shards is not None and args.shard is not None:
+		parser.error('only one of --shards and --shard can be used')
+	if args.resume and not args.journal:
+		parser.error('--resume needs --journal')
+	if args.journal and (args.delta or args.shard_db or args.serve is not None):
+		parser.error('--journal cannot be used with --delta, --shard-db or --serve')
+	if args.record and args.replay:
+		parser.error('only one of --record and --replay can be used')
+	if (args.record or args.replay) and (args.delta or args.cache_dir):
+		parser.error('--record and --replay cannot be used with --delta or --cache-dir')
+	if args.record and args.shards is not None:
+		parser.error('--record cannot be used with --shards')
+
+	METRICS_ENABLED = args.metrics is not None or args.serve is not None  # served on /metrics
+	profile = cProfile.Profile() if args.profile else None
+	if profile is not None:
+		profile.enable()
+	configure_journal(args.journal, args.resume)
+	configure_http_archive(args.record or args.replay, record=bool(args.record))
+	try:
+		succeeded = _run(args)
+	finally:
+		configure_journal(None)
+		configure_http_archive(None)
+		if profile is not None:
+			profile.disable()
+			profile.dump_stats(args.profile)
+		if args.metrics is not None:
+			write_metrics(args.metrics)
+	if not succeeded:
+		sys.exit(1)
+
+def _run(args):
+	if args.ndjson:
+		return write_ripe_fruits_ndjson(sys.stdout, max_workers=args.workers)
+	if args.serve is not None:
+		serve_snapshots(lambda: _get_json_string(args), args.serve, interval=args.interval)
+		return True
+	if args.shard is not None:
+		done, failed = run_shard_worker(args.shard_db, args.shard, max_workers=args.workers)
+		return not failed
+	if args.shards is not None:
+		if plan_shards(args.shard_db, args.crawl or [RIPE_FRUITS_URL], args.shards) is None:
+			print ''
+			return True
+		if args.plan_only:
+			return True
+		if not run_shards(args.shard_db, args.shards, max_workers=args.workers):
+			logging.error('Some shard workers failed')
+	if args.shard_db:
+		print merge_shards(args.shard_db)
+		return True
+	print _get_json_string(args)
+	return True
+
+def _get_json_string(args):
+	if args.crawl:
+		json_string = get_crawl_json(args.crawl, max_workers=args.workers)
+	elif args.delta:
+		json_string = get_ripe_fruits_delta_json(args.delta, max_workers=args.workers)
+	elif args.csv or args.columns:
+		store = get_ripe_fruits_store(max_workers=args.workers)
+		json_string = get_store_json(store) if store is not None else ''
+		if store is not None and args.csv:
+			with open(args.csv, 'wb') as f:
+				store.write_csv(f)
+		if store is not None and args.columns:
+			with open(args.columns, 'wb') as f:
+				store.write_columns(f)
+	else:
+		json_string = get_ripe_fruits_json(max_workers=args.workers)
+	return json_string
 
+load_selectors()
+configure_extraction_memo()
 
 if __name__ == '__main__':
 	main()
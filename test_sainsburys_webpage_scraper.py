@@ -1,18 +1,49 @@
 # Tested with Python2.7 on Linux Fedora x86_64 v24 
 
+from cStringIO import StringIO
 from decimal import Decimal
 import json
 import sainsburys_webpage_scraper
 from mock import call, Mock, patch, PropertyMock
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+import urllib2
+
+PRODUCT_PAGE = '''<html><head><title>Apricots</title></head><body>
+<div id="page"><div id="main"><div id="content"><div class="section productContent">
+<div class="mainProductInfoWrapper"><div class="mainProductInfo"><div class="tabs"><div id="information">
+<productcontent><htmlcontent><h3 class="productDataItemHeader">Description</h3>
+<div class="productText"><p>  Apricots
+</p><p>Other</p></div><div class="productText"><p>Nutrition</p></div>
+</htmlcontent></productcontent></div></div></div></div></div></div></div></div></body></html>'''
+
+LISTER_ITEM = '''<li><div class="product "><div class="productInner">
+<div class="productInfoWrapper"><div class="productInfo"><h3><a href="http://a/p%(i)s.html">Product %(i)s</a></h3></div></div>
+<div class="addToTrolleytabBox"><div class="addToTrolleytabContainer addItemBorderTop"><div class="pricingAndTrolleyOptions">
+<!-- Start UserSubscribedOrNot.jspf --><div id="addItem_%(i)s" class="priceTab activeContainer priceTabContainer">
+<div class="pricing"><p class="pricePerUnit">&pound%(i)s.50<abbr title="per">/</abbr></p></div></div>
+</div></div></div></div></div></li>'''
+
+LISTER_PAGE = '''<html><head><title>Ripe &amp; ready</title></head><body><ul class="nav"><li>Fruit</li></ul>
+<div id="page"><div id="main"><div id="content"><div id="productsContainer"><div id="productLister">
+<ul class="productLister listView">%s</ul></div></div></div></div></div></body></html>''' % ''.join(LISTER_ITEM % {'i': i} for i in xrange(1, 4))
+
+SELECT = sainsburys_webpage_scraper.select
+HTML = sainsburys_webpage_scraper.html
 
 class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 	def setUp(self):
 		self.requests_patch = patch('sainsburys_webpage_scraper.requests')
 		self.requests_mock = self.requests_patch.start()
+		self.session_mock = self.requests_mock.Session.return_value
+		sainsburys_webpage_scraper._session = None  # so that the shared session is built from requests_mock
 		self.response_mock = Mock()
 		type(self.response_mock).content = PropertyMock(return_value='')  # response.content should be a string
-		self.requests_mock.get.return_value = self.response_mock
+		self.session_mock.get.return_value = self.response_mock
+		sainsburys_webpage_scraper.configure_extraction_memo()  # pages parsed by previous tests are not remembered
 
 		self.html_patch = patch('sainsburys_webpage_scraper.html')
 		self.html_mock = self.html_patch.start()
@@ -25,6 +56,10 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 		self.logging_patch = patch('sainsburys_webpage_scraper.logging')
 		self.logging_mock = self.logging_patch.start()
 
+		# Compiled XPath objects cannot be evaluated on mocks, the elements' own xpath() is used instead.
+		self.select_patch = patch('sainsburys_webpage_scraper.select', side_effect=lambda field, node: node.xpath(field))
+		self.select_mock = self.select_patch.start()
+
 		self.ul_mock = Mock()
 		self.li_mock1 = Mock()
 		self.li_mock2 = Mock()
@@ -36,19 +71,21 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 		self.html_patch.stop()
 		self.StringIO_patch.stop()
 		self.logging_patch.stop()
+		self.select_patch.stop()
+		sainsburys_webpage_scraper._session = None
 
 	def test_get_ripe_fruits_json_1(self):
 		'''Should return '' on failure of requests.get().'''
-		self.requests_mock.get.side_effect = Exception()
+		self.session_mock.get.side_effect = Exception()
 		self.assertEqual(sainsburys_webpage_scraper.get_ripe_fruits_json(), '')
-		self.requests_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		self.assertTrue(len(self.logging_mock.error.call_args_list) == 1)
 
 	def test_get_ripe_fruits_json_2(self):
 		'''Should return '' on failure to locate the <ul> element.'''		
 		self.tree_mock.xpath.return_value = []
 		self.assertEqual(sainsburys_webpage_scraper.get_ripe_fruits_json(), '')
-		self.requests_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		self.assertTrue(len(self.logging_mock.error.call_args_list) == 1)
 
 	def test_get_ripe_fruits_json_3(self):	
@@ -60,7 +97,7 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 			"total": "0"
 		}
 		output = sainsburys_webpage_scraper.get_ripe_fruits_json()
-		self.requests_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		self.assertEqual(json.loads(output), expected)		
 
 	@patch('sainsburys_webpage_scraper.get_product_details_dict')
@@ -73,7 +110,7 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 			"total": "0"
 		}
 		output = sainsburys_webpage_scraper.get_ripe_fruits_json()
-		self.requests_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		self.assertEqual(json.loads(output), expected)
 		self.assertEqual(get_product_details_dict_mock.call_args_list, [call(self.li_mock1), call(self.li_mock2), call(self.li_mock3)])
 		self.assertTrue(len(self.logging_mock.warn.call_args_list) == 3)
@@ -93,7 +130,7 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 			"total": "1.5"
 		}
 		output = sainsburys_webpage_scraper.get_ripe_fruits_json()
-		self.requests_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		self.assertEqual(json.loads(output), expected)
 		self.assertEqual(get_product_details_dict_mock.call_args_list, [call(self.li_mock1), call(self.li_mock2), call(self.li_mock3)])
 
@@ -115,11 +152,218 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 			"total": "1.1"
 		}
 		output = sainsburys_webpage_scraper.get_ripe_fruits_json()
-		self.requests_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		self.assertEqual(json.loads(output), expected)
 		self.assertEqual(get_product_details_dict_mock.call_args_list, [call(self.li_mock1), call(self.li_mock2), call(self.li_mock3)])
 		self.assertTrue(len(self.logging_mock.warn.call_args_list) == 1)
 
+	def test_product_store(self):
+		'''A ProductStore should give back the dictionaries appended to it, sum their prices exactly and round-trip through its exports.'''
+		product_details_dicts = [
+			{'unit_price': '3.50', 'title': 'Apricots', 'size': '38kb', 'description': u'Caf\xe9'},
+			{'unit_price': '0.5', 'some_attribute': 'xyz'},
+			{'unit_price': '.5', 'size': '05kb', 'title': None, 'description': 'Apricots'},
+			{'unit_price': '10', 'size': 12},
+		]
+		store = sainsburys_webpage_scraper.ProductStore()
+		self.assertEqual(store.total(), 0)
+		for product_details_dict in product_details_dicts:
+			store.append(product_details_dict)
+		self.assertEqual(len(store), 4)
+		self.assertEqual(list(store), product_details_dicts)
+		self.assertEqual(store[-1], product_details_dicts[-1])
+		self.assertEqual(str(store.total()), str(sainsburys_webpage_scraper.sum_unit_prices(product_details_dicts)))
+		self.assertEqual(str(store.total()), '14.50')
+
+		f = StringIO()
+		store.write_columns(f)
+		f.seek(0)
+		self.assertEqual(list(sainsburys_webpage_scraper.ProductStore.read_columns(f)), product_details_dicts)
+
+		f = StringIO()
+		store.write_csv(f)
+		self.assertEqual(f.getvalue().splitlines(), [
+			'title,unit_price,size,description,some_attribute',
+			'Apricots,3.50,38kb,Caf\xc3\xa9,',
+			',0.5,,,xyz',
+			',.5,05kb,Apricots,',
+			',10,12,,',
+		])
+
+	@patch('sainsburys_webpage_scraper.get_product_listing_details')
+	@patch('sainsburys_webpage_scraper.get_product_page_details')
+	def test_get_ripe_fruits_json_7(self, get_product_page_details_mock, get_product_listing_details_mock):
+		'''Concurrent scenario, products should keep their order and failed products should still be skipped.'''
+		self.tree_mock.xpath.return_value = [self.ul_mock]
+		li_mock4 = Mock()
+		self.ul_mock.getchildren.return_value = [self.li_mock1, self.li_mock2, self.li_mock3, li_mock4]
+		get_product_listing_details_mock.side_effect = lambda li: {
+			self.li_mock1: ({'unit_price': '0.5'}, 'link1'),
+			self.li_mock2: ({}, None),
+			self.li_mock3: ({'unit_price': '0.6'}, 'link3'),
+			li_mock4: ({'unit_price': '0.7'}, 'link4'),
+		}[li]
+		get_product_page_details_mock.side_effect = lambda product_details_dict, link: {
+			'link1': dict(product_details_dict, description='1'),
+			'link3': {},
+			'link4': dict(product_details_dict, description='4'),
+		}[link]
+		expected = {
+			"results":
+				[
+					{"unit_price": "0.5", "description": "1"},
+					{"unit_price": "0.7", "description": "4"}
+				],
+			"total": "1.2"
+		}
+		output = sainsburys_webpage_scraper.get_ripe_fruits_json(max_workers=3)
+		self.assertEqual(json.loads(output), expected)
+		self.assertEqual(get_product_listing_details_mock.call_args_list, [call(self.li_mock1), call(self.li_mock2), call(self.li_mock3), call(li_mock4)])
+		self.assertEqual(len(get_product_page_details_mock.call_args_list), 3)
+		self.assertTrue(len(self.logging_mock.warn.call_args_list) == 2)
+
+	@patch('sainsburys_webpage_scraper.get_product_details_dict')
+	def test_write_ripe_fruits_ndjson(self, get_product_details_dict_mock):
+		'''Each product should be written on its own line as soon as it is retrieved, followed by the total.'''
+		self.tree_mock.xpath.return_value = [self.ul_mock]
+		out = Mock()
+		lines = []
+		def get_product_details_dict(li):
+			lines.append(len(out.write.call_args_list))  # no. of lines written when the product is requested
+			return [{'unit_price': '0.5', 'title': 'a'}, {}, {'unit_price': '0.6'}][len(lines) - 1]
+		get_product_details_dict_mock.side_effect = get_product_details_dict
+		self.assertTrue(sainsburys_webpage_scraper.write_ripe_fruits_ndjson(out))
+		self.assertEqual(lines, [0, 1, 1])
+		self.assertEqual([json.loads(c[0][0]) for c in out.write.call_args_list], [
+			{'unit_price': '0.5', 'title': 'a'},
+			{'unit_price': '0.6'},
+			{'products': 2, 'skipped': 1, 'total': '1.1'}
+		])
+		self.assertTrue(all(c[0][0].endswith('\n') and c[0][0].count('\n') == 1 for c in out.write.call_args_list))
+		self.assertTrue(len(self.logging_mock.warn.call_args_list) == 1)
+
+		# Nothing should be written if the <ul> element could not be found:
+		out.reset_mock()
+		self.tree_mock.xpath.return_value = []
+		self.assertFalse(sainsburys_webpage_scraper.write_ripe_fruits_ndjson(out))
+		self.assertFalse(out.write.called)
+
+	@patch('sainsburys_webpage_scraper.get_product_id')
+	@patch('sainsburys_webpage_scraper.get_product_listing_details')
+	@patch('sainsburys_webpage_scraper.get_product_page_details')
+	def test_get_ripe_fruits_delta_json(self, get_product_page_details_mock, get_product_listing_details_mock, get_product_id_mock):
+		'''Only new products and products whose price or title changed should be fetched.'''
+		snapshot_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, snapshot_dir)
+		snapshot_path = os.path.join(snapshot_dir, 'snapshot.json')
+		self.tree_mock.xpath.return_value = [self.ul_mock]
+		for li_mock, product_id in [(self.li_mock1, '1'), (self.li_mock2, '2'), (self.li_mock3, '3')]:
+			li_mock.product_id = product_id
+			li_mock.details = {'unit_price': '1.5', 'title': 'title' + product_id}
+		get_product_id_mock.side_effect = lambda li: li.product_id
+		get_product_listing_details_mock.side_effect = lambda li: (dict(li.details), 'link' + li.product_id)
+		def get_product_page_details(product_details_dict, link, page_info):
+			page_info.update(size='1kb', description=link, etag='"%s"' % link, last_modified=None)
+			return dict(product_details_dict, size='1kb', description=link)
+		get_product_page_details_mock.side_effect = get_product_page_details
+
+		# First run, no snapshot yet:
+		output = json.loads(sainsburys_webpage_scraper.get_ripe_fruits_delta_json(snapshot_path))
+		self.assertEqual([record['id'] for record in output['added']], ['1', '2', '3'])
+		self.assertEqual(output['added'][0], {'id': '1', 'unit_price': '1.5', 'title': 'title1', 'size': '1kb', 'description': 'link1'})
+		self.assertEqual((output['changed'], output['removed'], output['unchanged'], output['total']), ([], [], 0, '4.5'))
+		self.assertEqual(len(get_product_page_details_mock.call_args_list), 3)
+		get_product_page_details_mock.reset_mock()
+
+		# Second run, product 1's price changed, product 2 is gone, product 4 is new and product 3 did not change:
+		li_mock4 = Mock(product_id='4', details={'unit_price': '2', 'title': 'title4'})
+		self.ul_mock.getchildren.return_value = [self.li_mock1, self.li_mock3, li_mock4]
+		self.li_mock1.details['unit_price'] = '1.2'
+		output = json.loads(sainsburys_webpage_scraper.get_ripe_fruits_delta_json(snapshot_path, max_workers=2))
+		self.assertEqual(sorted(c[0][1] for c in get_product_page_details_mock.call_args_list), ['link1', 'link4'])
+		page_info = [c[0][2] for c in get_product_page_details_mock.call_args_list if c[0][1] == 'link1'][0]
+		self.assertEqual(page_info['etag'], '"link1"')  # validators from the snapshot
+		self.assertEqual([record['id'] for record in output['added']], ['4'])
+		self.assertEqual(output['changed'], [{'id': '1', 'unit_price': '1.2', 'title': 'title1', 'size': '1kb', 'description': 'link1', 
+											  'previous': {'unit_price': '1.5'}}])
+		self.assertEqual([record['id'] for record in output['removed']], ['2'])
+		self.assertEqual((output['unchanged'], output['total']), (1, '4.7'))
+		self.assertEqual(list(sainsburys_webpage_scraper.load_snapshot(snapshot_path).keys()), ['1', '3', '4'])
+		get_product_page_details_mock.reset_mock()
+
+		# Third run, product 1's price changed again but its page could not be fetched:
+		self.li_mock1.details['unit_price'] = '1.0'
+		get_product_page_details_mock.side_effect = lambda product_details_dict, link, page_info: {}
+		output = json.loads(sainsburys_webpage_scraper.get_ripe_fruits_delta_json(snapshot_path))
+		self.assertEqual((output['added'], output['changed'], output['removed'], output['unchanged']), ([], [], [], 2))
+		self.assertEqual(output['total'], '4.5')  # with product 1's current price
+		self.assertEqual(sainsburys_webpage_scraper.load_snapshot(snapshot_path)['1']['unit_price'], '1.2')  # retried next time
+
+	@patch('sainsburys_webpage_scraper._parse_pool')
+	def test_get_product_page_details_parse_pool(self, parse_pool_mock):
+		'''With a parse pool, the product page should be parsed by one of its processes.'''
+		type(self.response_mock).content = PropertyMock(return_value='a' * 3000)
+		parse_pool_mock.apply.return_value = ('123',)
+		output = sainsburys_webpage_scraper.get_product_page_details({'unit_price': '3.5'}, 'link')
+		self.assertEqual(output, {'unit_price': '3.5', 'size': '2kb', 'description': '123'})
+		parse_pool_mock.apply.assert_called_once_with(sainsburys_webpage_scraper.parse_product_page_fields, ('a' * 3000,))
+
+		type(self.response_mock).content = PropertyMock(return_value='b' * 3000)  # not in the extraction memo
+		parse_pool_mock.apply.return_value = (None,)
+		self.assertEqual(sainsburys_webpage_scraper.get_product_page_details({'unit_price': '3.5'}, 'link'), {})
+
+	def test_parse_product_page_fields(self):
+		'''Should return a tuple of the fields found on the product page.'''
+		div_mock = Mock(**{'xpath.return_value': [Mock(text=' 123 ')]})
+		self.tree_mock.xpath.return_value = [div_mock]
+		self.assertEqual(sainsburys_webpage_scraper.parse_product_page_fields('abc'), ('123',))
+		self.tree_mock.xpath.return_value = []
+		self.assertEqual(sainsburys_webpage_scraper.parse_product_page_fields('abc'), (None,))
+
+	def test_get_product_page_details_not_modified(self):
+		'''A "304 Not Modified" response should reuse what is known about the page.'''
+		self.response_mock.status_code = 304
+		page_info = {'size': '3kb', 'description': 'abc', 'etag': '"1"', 'last_modified': None}
+		output = sainsburys_webpage_scraper.get_product_page_details({'unit_price': '3.5'}, 'link', page_info)
+		self.assertEqual(output, {'unit_price': '3.5', 'size': '3kb', 'description': 'abc'})
+		self.session_mock.get.assert_called_once_with('link', timeout=sainsburys_webpage_scraper.TIMEOUT, headers={'If-None-Match': '"1"'})
+
+	@patch('sainsburys_webpage_scraper.get_lister_tree')
+	@patch('sainsburys_webpage_scraper.get_product_listing_details')
+	@patch('sainsburys_webpage_scraper.get_product_page_details')
+	def test_get_crawl_json(self, get_product_page_details_mock, get_product_listing_details_mock, get_lister_tree_mock):
+		'''Lister pages should be followed and products listed more than once should only be fetched and counted once, 
+		but be in the results of every seed URL leading to a page listing them.'''
+		trees = {}
+		for url, products, next_page in [('http://a/1', ['p1', '/p2#x'], '2'),
+										 ('http://a/2', ['p3'], '1'),  # links back to the 1st page
+										 ('http://b/1', ['http://a/p2', 'p4', None], None)]:
+			tree_mock = Mock()
+			lis = [Mock(product=product) for product in products]
+			tree_mock.xpath.side_effect = lambda field, lis=lis, next_page=next_page: {
+				'product_list': [Mock(**{'getchildren.return_value': lis})],
+				'next_page': [Mock(**{'get.return_value': next_page})] if next_page else [],
+			}[field]
+			trees[url] = tree_mock
+		get_lister_tree_mock.side_effect = lambda url: trees.get(url)
+		get_product_listing_details_mock.side_effect = lambda li: ({'unit_price': '1.5', 'title': li.product}, li.product) if li.product else ({}, None)
+		get_product_page_details_mock.side_effect = lambda product_details_dict, link: {} if link.endswith('p4') else dict(product_details_dict, description=link)
+
+		output = json.loads(sainsburys_webpage_scraper.get_crawl_json(['http://a/1', 'http://b/1', 'http://c/1', 'http://a/2'], max_workers=2))
+		# http://a/2 is fetched as a seed URL before the 1st page's "next page" link is followed, and only once:
+		self.assertEqual(get_lister_tree_mock.call_args_list, [call('http://a/1'), call('http://b/1'), call('http://c/1'), call('http://a/2')])
+		self.assertEqual(sorted(c[0][1] for c in get_product_page_details_mock.call_args_list), ['http://a/p1', 'http://a/p2', 'http://a/p3', 'http://b/p4'])
+		self.assertEqual(output['products'], 3)
+		self.assertEqual(output['total'], '4.5')
+		self.assertEqual([(lister['url'], [r['description'] for r in lister['results']], lister['total']) for lister in output['listers']], [
+			('http://a/1', ['http://a/p1', 'http://a/p2', 'http://a/p3'], '4.5'),
+			('http://b/1', ['http://a/p2'], '1.5'),
+			('http://a/2', ['http://a/p3', 'http://a/p1', 'http://a/p2'], '4.5'),
+		])
+
+		# Nothing could be fetched:
+		self.assertEqual(sainsburys_webpage_scraper.get_crawl_json(['http://c/1']), '')
+
 	@patch('sainsburys_webpage_scraper.get_product_unit_price')
 	@patch('sainsburys_webpage_scraper.get_product_link_element')
 	@patch('sainsburys_webpage_scraper.get_product_additional_details_dict')
@@ -153,18 +397,18 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 		# 4 - Link successfully retrieved but timed out during conection:
 		link_mock = Mock()
 		link_element_mock.values.return_value = [link_mock]
-		self.requests_mock.get.side_effect = Exception()
+		self.session_mock.get.side_effect = Exception()
 		self.assertEqual(sainsburys_webpage_scraper.get_product_details_dict(self.li_mock1), {})
-		self.requests_mock.get.assert_called_once_with(link_mock, timeout=sainsburys_webpage_scraper.TIMEOUT)
-		self.requests_mock.get.reset_mock()
-		self.requests_mock.get.side_effect = None 
+		self.session_mock.get.assert_called_once_with(link_mock, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.reset_mock()
+		self.session_mock.get.side_effect = None 
 		self.assertTrue(len(self.logging_mock.error.call_args_list) == 1)
 		self.logging_mock.reset_mock()
 		
 		# 5 - Could not get 'description' (i.e. get_product_additional_details_dict() returned {}):
 		get_product_additional_details_dict_mock.return_value = {}
 		self.assertEqual(sainsburys_webpage_scraper.get_product_details_dict(self.li_mock1), {})
-		self.requests_mock.get.assert_called_once_with(link_mock, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(link_mock, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		get_product_additional_details_dict_mock.assert_called_once_with(self.response_mock.content)
 		self.assertTrue(len(self.logging_mock.error.call_args_list) == 1)
 		
@@ -196,9 +440,487 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 		}
 		output = sainsburys_webpage_scraper.get_product_details_dict(Mock())
 		self.assertEqual(output, expected)
-		self.requests_mock.get.assert_called_once_with(link_mock, timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.assert_called_once_with(link_mock, timeout=sainsburys_webpage_scraper.TIMEOUT)
 		get_product_additional_details_dict_mock.assert_called_once_with(self.response_mock.content)
 
+	@patch('sainsburys_webpage_scraper.iter_lister_pages')
+	@patch('sainsburys_webpage_scraper.get_product_page_details')
+	def test_shards(self, get_product_page_details_mock, iter_lister_pages_mock):
+		'''Products should be queued once in their shard, retried up to SHARD_MAX_ATTEMPTS and merged in listing order.'''
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		db_path = os.path.join(directory, 'shards.db')
+		self.assertIsNone(sainsburys_webpage_scraper.plan_shards(db_path, ['http://a/1'], 3))
+		self.assertEqual(sainsburys_webpage_scraper.merge_shards(db_path), '')
+
+		iter_lister_pages_mock.return_value = [
+			('http://a/1', 'http://a/1', [('http://a/p%s' % i, {'unit_price': '0.%s0' % i}) for i in xrange(1, 7)]),
+			('http://a/1', 'http://a/2', [('http://a/p2', {'unit_price': '0.20'}), ('http://a/p7', {'unit_price': '1.05'})]),
+		]
+		self.assertEqual(sainsburys_webpage_scraper.plan_shards(db_path, ['http://a/1'], 3), 7)
+		attempts = {}
+		def get_product_page_details(product_details_dict, link):
+			attempts[link] = attempts.get(link, 0) + 1
+			if link == 'http://a/p3' or link == 'http://a/p5' and attempts[link] == 1:
+				return {}
+			return dict(product_details_dict, description=link[-2:])
+		get_product_page_details_mock.side_effect = get_product_page_details
+
+		shards = [sainsburys_webpage_scraper.get_shard('http://a/p%s' % i, 3) for i in xrange(1, 8)]
+		for shard in reversed(xrange(3)):
+			done, failed = sainsburys_webpage_scraper.run_shard_worker(db_path, shard, max_workers=2)
+			self.assertEqual(done, shards.count(shard) - (shard == shards[2]))
+			self.assertEqual(failed, int(shard == shards[2]))  # not p5, done on its 2nd attempt
+		self.assertEqual(sainsburys_webpage_scraper.run_shard_worker(db_path, shards[2]), (0, 1))  # gave up on p3
+		self.assertEqual(attempts['http://a/p3'], sainsburys_webpage_scraper.SHARD_MAX_ATTEMPTS)
+		self.assertEqual(attempts['http://a/p2'], 1)
+
+		output = json.loads(sainsburys_webpage_scraper.merge_shards(db_path))
+		self.assertEqual([product['description'] for product in output['results']], ['p1', 'p2', 'p4', 'p5', 'p6', 'p7'])
+		self.assertEqual(output['total'], '2.85')
+		self.assertTrue(len(self.logging_mock.warn.call_args_list) > 0)
+
+		# Products claimed by a worker which died are claimed again, unless it was their last attempt:
+		connection = sainsburys_webpage_scraper._connect_shard_db(db_path)
+		with connection:
+			connection.execute("UPDATE products SET status = 'claimed', claimed_at = 0, attempts = ? WHERE url = 'http://a/p7'",
+							   (sainsburys_webpage_scraper.SHARD_MAX_ATTEMPTS - 1,))
+			connection.execute("UPDATE products SET status = 'claimed', claimed_at = 0, attempts = ? WHERE url = 'http://a/p6'",
+							   (sainsburys_webpage_scraper.SHARD_MAX_ATTEMPTS,))
+		connection.close()
+		done, failed = sainsburys_webpage_scraper.run_shard_worker(db_path, shards[6])
+		self.assertEqual((done, failed), (1, int(shards[6] == shards[2])))  # p7 is done again
+		done, failed = sainsburys_webpage_scraper.run_shard_worker(db_path, shards[5])
+		self.assertEqual((done, failed), (0, 1 + (shards[5] == shards[2])))  # p6 is left failed
+		output = json.loads(sainsburys_webpage_scraper.merge_shards(db_path))
+		self.assertEqual([product['description'] for product in output['results']], ['p1', 'p2', 'p4', 'p5', 'p7'])
+
+	def test_get_shard(self):
+		'''A product URL should get the same shard whether it is a str or a unicode, with non-ASCII characters.'''
+		get_shard = sainsburys_webpage_scraper.get_shard
+		self.assertEqual(get_shard(u'http://a/caf\xe9', 1000), get_shard('http://a/caf\xc3\xa9', 1000))
+		self.assertEqual(get_shard(u'http://a/1', 1000), get_shard('http://a/1', 1000))
+		self.assertTrue(0 <= get_shard(u'http://a/caf\xe9', 3) < 3)
+
+	def test_get_session(self):
+		'''The same session should be reused by every fetch until it is reconfigured.'''
+		session = sainsburys_webpage_scraper.get_session()
+		self.assertEqual(session, self.session_mock)
+		self.assertEqual(sainsburys_webpage_scraper.get_session(), session)
+		self.requests_mock.Session.assert_called_once_with()
+		self.requests_mock.adapters.HTTPAdapter.assert_called_once_with(pool_connections=sainsburys_webpage_scraper.POOL_CONNECTIONS,
+																		 pool_maxsize=sainsburys_webpage_scraper.POOL_MAXSIZE,
+																		 pool_block=sainsburys_webpage_scraper.POOL_BLOCK)
+		adapter_mock = self.requests_mock.adapters.HTTPAdapter.return_value
+		self.assertEqual(session.mount.call_args_list, [call('http://', adapter_mock), call('https://', adapter_mock)])
+		session.headers.update.assert_called_once_with({'Accept-Encoding': sainsburys_webpage_scraper.ACCEPT_ENCODING})
+
+		sainsburys_webpage_scraper.fetch('abc')
+		sainsburys_webpage_scraper.fetch('def')
+		self.assertEqual(session.get.call_args_list, [call('abc', timeout=sainsburys_webpage_scraper.TIMEOUT), 
+													  call('def', timeout=sainsburys_webpage_scraper.TIMEOUT)])
+
+		# Reconfiguring closes the old session:
+		sainsburys_webpage_scraper.configure_session(pool_maxsize=3)
+		session.close.assert_called_once_with()
+		self.requests_mock.adapters.HTTPAdapter.assert_called_with(pool_connections=sainsburys_webpage_scraper.POOL_CONNECTIONS,
+																   pool_maxsize=3,
+																   pool_block=sainsburys_webpage_scraper.POOL_BLOCK)
+
+	def test_fetch_with_http_cache(self):
+		'''Cached pages should be revalidated and a 304 response should give back the cached markup.'''
+		cache_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, cache_dir)
+		self.addCleanup(sainsburys_webpage_scraper.configure_http_cache, None)
+		sainsburys_webpage_scraper.configure_http_cache(cache_dir)
+
+		# First fetch, the page is not cached yet:
+		self.session_mock.get.return_value = Mock(status_code=200, headers={'ETag': '"1"', 'Last-Modified': 'Mon'}, content='abc')
+		self.assertEqual(sainsburys_webpage_scraper.fetch('link').content, 'abc')
+		self.session_mock.get.assert_called_once_with('link', timeout=sainsburys_webpage_scraper.TIMEOUT)
+		self.session_mock.get.reset_mock()
+
+		# Second fetch, the page did not change:
+		self.session_mock.get.return_value = Mock(status_code=304, headers={}, content='')
+		response = sainsburys_webpage_scraper.fetch('link')
+		self.assertEqual((response.status_code, response.content), (200, 'abc'))
+		self.session_mock.get.assert_called_once_with('link', timeout=sainsburys_webpage_scraper.TIMEOUT, 
+													  headers={'If-None-Match': '"1"', 'If-Modified-Since': 'Mon'})
+		self.session_mock.get.reset_mock()
+
+		# Third fetch, the page changed:
+		self.session_mock.get.return_value = Mock(status_code=200, headers={'ETag': '"2"'}, content='abcd')
+		self.assertEqual(sainsburys_webpage_scraper.fetch('link').content, 'abcd')
+		self.assertEqual(sainsburys_webpage_scraper.configure_http_cache(cache_dir).get('link').content, 'abcd')  # persisted
+
+		# Pages are not revalidated within max_age:
+		self.session_mock.get.reset_mock()
+		sainsburys_webpage_scraper.configure_http_cache(cache_dir, max_age=60)
+		self.assertEqual(sainsburys_webpage_scraper.fetch('link').content, 'abcd')
+		self.assertFalse(self.session_mock.get.called)
+
+	def test_http_cache_eviction(self):
+		'''The least recently used pages should be evicted once the cache is full.'''
+		cache_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, cache_dir)
+		http_cache = sainsburys_webpage_scraper.HttpCache(cache_dir, max_bytes=6)
+		with patch('sainsburys_webpage_scraper.time') as time_mock:
+			for i, url in enumerate(['a', 'b', 'a', 'c']):
+				time_mock.time.return_value = i
+				if url == 'a' and i:
+					self.assertEqual(http_cache.get(url).content, 'aaa')
+				else:
+					http_cache.store(url, Mock(headers={'ETag': url}, content=url*3))
+		self.assertEqual(http_cache.get('b'), None)
+		self.assertEqual(http_cache.get('a').content, 'aaa')
+		self.assertEqual(http_cache.get('c').content, 'ccc')
+		self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+	def test_get_product_additional_details_dict_incremental(self):
+		'''Should count every byte of the page and stop parsing once the description is found.'''
+		self.select_mock.side_effect = SELECT
+		chunks = [PRODUCT_PAGE[i:i+10] for i in xrange(0, len(PRODUCT_PAGE), 10)]
+		chunks.append('<p' * 5000)  # after the description, should be counted but not parsed
+		output = sainsburys_webpage_scraper.get_product_additional_details_dict_incremental(iter(chunks))
+		self.assertEqual(output, (len(PRODUCT_PAGE) + 10000, {'description': 'Apricots'}))
+		self.assertEqual(len(self.logging_mock.error.call_args_list), 0)
+
+		# Another <div class="productText"> before the one on the selector's path, whatever the chunks:
+		page = PRODUCT_PAGE.replace('<div id="page">', '<div class="productText"><p>Promo</p></div><div id="page">')
+		for chunks in [[page], [page[i:i+7] for i in xrange(0, len(page), 7)]]:
+			output = sainsburys_webpage_scraper.get_product_additional_details_dict_incremental(iter(chunks))
+			self.assertEqual(output, (len(page), {'description': 'Apricots'}))
+		# The description's </p> only comes out once the parser is closed:
+		page = PRODUCT_PAGE[:PRODUCT_PAGE.index('</p>')]
+		self.assertEqual(sainsburys_webpage_scraper.get_product_additional_details_dict_incremental(iter([page])), (len(page), {'description': 'Apricots'}))
+		self.assertEqual(len(self.logging_mock.error.call_args_list), 0)
+
+		# Description not found:
+		page = PRODUCT_PAGE.replace('id="information"', 'id="nutrition"')
+		output = sainsburys_webpage_scraper.get_product_additional_details_dict_incremental(iter([page]))
+		self.assertEqual(output, (len(page), {}))
+		self.assertEqual(len(self.logging_mock.error.call_args_list), 1)
+
+	@patch('sainsburys_webpage_scraper.STREAM_LISTER', True)
+	@patch('sainsburys_webpage_scraper.get_product_page_details')
+	def test_get_ripe_fruits_json_stream_lister(self, get_product_page_details_mock):
+		'''Each product should be requested as soon as its <li> is parsed, and the <li> freed once the next one is parsed.'''
+		self.select_mock.side_effect = SELECT
+		self.html_patch.stop()
+		self.html_patch = patch('sainsburys_webpage_scraper.html', HTML)  # the real one, stopped by tearDown()
+		self.html_patch.start()
+		chunks = [LISTER_PAGE[i:i+100] for i in xrange(0, len(LISTER_PAGE), 100)]
+		chunks_read = []
+		def iter_content(chunk_size):
+			for chunk in chunks:
+				chunks_read.append(chunk)
+				yield chunk
+		self.response_mock.iter_content.side_effect = iter_content
+		requested = []
+		def get_product_page_details(product_details_dict, link):
+			requested.append((link, len(chunks_read)))
+			return dict(product_details_dict, description=link)
+		get_product_page_details_mock.side_effect = get_product_page_details
+
+		output = json.loads(sainsburys_webpage_scraper.get_ripe_fruits_json())
+		self.session_mock.get.assert_called_once_with(sainsburys_webpage_scraper.RIPE_FRUITS_URL, timeout=sainsburys_webpage_scraper.TIMEOUT, stream=True)
+		self.assertEqual(output, {'results': [{'unit_price': '%s.50' % i, 'title': 'Product %s' % i, 'description': 'http://a/p%s.html' % i}
+											  for i in xrange(1, 4)], 'total': '7.50'})
+		self.assertTrue(requested[0][1] < requested[1][1] < requested[2][1] < len(chunks))
+		self.response_mock.close.assert_called_once_with()
+
+		# The <li> elements already processed should have been freed:
+		items = sainsburys_webpage_scraper.StreamedListerItems('url', Mock(**{'iter_content.return_value': chunks}))
+		self.assertEqual([li.getprevious() for li in items], [None, None, None])
+		self.assertTrue(items.found)
+
+		# Nothing should be output if the <ul> element could not be found:
+		chunks = [LISTER_PAGE.replace('productLister listView', 'productLister gridView')]
+		self.assertEqual(sainsburys_webpage_scraper.get_ripe_fruits_json(), '')
+		self.assertEqual(len(requested), 3)
+
+		# Nor if reading the page fails midway, as without STREAM_LISTER:
+		def iter_content(chunk_size):
+			yield LISTER_PAGE[:LISTER_PAGE.index('</li>') + len('</li>')]
+			raise sainsburys_webpage_scraper.socket.error('Connection reset by peer')
+		self.response_mock.iter_content.side_effect = iter_content
+		self.logging_mock.reset_mock()
+		self.assertEqual(sainsburys_webpage_scraper.get_ripe_fruits_json(), '')
+		out = StringIO()
+		self.assertFalse(sainsburys_webpage_scraper.write_ripe_fruits_ndjson(out))
+		self.assertEqual(len(self.logging_mock.error.call_args_list), 2)
+		self.assertTrue(self.logging_mock.error.call_args[0][0].startswith('Connecting to'))
+
+	@patch('sainsburys_webpage_scraper.INCREMENTAL_PARSE', True)
+	@patch('sainsburys_webpage_scraper.get_product_additional_details_dict_incremental')
+	def test_get_product_page_details_incremental(self, get_product_additional_details_dict_incremental_mock):
+		'''The product page should be streamed to the incremental parser.'''
+		get_product_additional_details_dict_incremental_mock.return_value = (2048, {'description': '123'})
+		output = sainsburys_webpage_scraper.get_product_page_details({'unit_price': '3.5'}, 'link')
+		self.assertEqual(output, {'unit_price': '3.5', 'size': '2kb', 'description': '123'})
+		self.session_mock.get.assert_called_once_with('link', timeout=sainsburys_webpage_scraper.TIMEOUT, stream=True)
+		self.response_mock.iter_content.assert_called_once_with(sainsburys_webpage_scraper.CHUNK_SIZE)
+		get_product_additional_details_dict_incremental_mock.assert_called_once_with(self.response_mock.iter_content.return_value)
+
+		# Connection dropped while reading the page:
+		get_product_additional_details_dict_incremental_mock.side_effect = Exception()
+		self.assertEqual(sainsburys_webpage_scraper.get_product_page_details({'unit_price': '3.5'}, 'link'), {})
+		self.response_mock.close.assert_called_once_with()
+		self.assertEqual(len(self.logging_mock.error.call_args_list), 1)
+
+	def test_select(self):
+		'''Fallback selectors should be tried in order and selectors should be overridable from a JSON file.'''
+		self.select_mock.side_effect = SELECT
+		self.addCleanup(sainsburys_webpage_scraper.load_selectors)
+		tree = sainsburys_webpage_scraper.etree.fromstring(PRODUCT_PAGE, sainsburys_webpage_scraper.etree.HTMLParser()).getroottree()
+		product_text_div = sainsburys_webpage_scraper.select('product_text', tree)[0]
+		self.assertEqual(sainsburys_webpage_scraper.select('description', product_text_div)[0].text, '  Apricots\n')
+		
+		selectors_file = tempfile.NamedTemporaryFile(suffix='.json')
+		self.addCleanup(selectors_file.close)
+		json.dump({'description': ['span', 'p[2]'], 'product_text': "//div[@class='productText'][2]"}, selectors_file)
+		selectors_file.flush()
+		sainsburys_webpage_scraper.load_selectors(selectors_file.name)
+		self.assertEqual(sainsburys_webpage_scraper.select('description', product_text_div)[0].text, 'Other')  # fallback
+		product_text_div = sainsburys_webpage_scraper.select('product_text', tree)[0]
+		self.assertEqual(sainsburys_webpage_scraper.select('description', product_text_div), [])
+
+		# Unknown fields and invalid expressions should be noticed straight away:
+		for overrides in [{'descriptions': 'p'}, {'description': 'p['}]:
+			selectors_file.seek(0)
+			selectors_file.truncate()
+			json.dump(overrides, selectors_file)
+			selectors_file.flush()
+			self.assertRaises((ValueError, sainsburys_webpage_scraper.etree.XPathSyntaxError), 
+							  sainsburys_webpage_scraper.load_selectors, selectors_file.name)
+
+	def test_metrics(self):
+		'''Timers and counters should only be collected when metrics are enabled.'''
+		self.addCleanup(sainsburys_webpage_scraper._metrics.reset)
+		sainsburys_webpage_scraper._metrics.reset()
+		with sainsburys_webpage_scraper.timed('parse'):
+			sainsburys_webpage_scraper.count_failure('xpath')
+		self.assertEqual(sainsburys_webpage_scraper.get_metrics()['counters'], {})
+		self.assertEqual(sainsburys_webpage_scraper.get_metrics()['timers'], {})
+
+		with patch('sainsburys_webpage_scraper.METRICS_ENABLED', True):
+			with patch('sainsburys_webpage_scraper.time') as time_mock:
+				time_mock.time.side_effect = [10, 10.125, 20, 20.5]
+				with sainsburys_webpage_scraper.timed('parse'):
+					sainsburys_webpage_scraper.count_failure('xpath')
+				with sainsburys_webpage_scraper.timed('parse'):
+					sainsburys_webpage_scraper.count('bytes.product_pages', 100)
+			self.session_mock.get.side_effect = ValueError()
+			self.assertEqual(sainsburys_webpage_scraper.get_product_page_details({}, 'link'), {})
+		metrics = json.loads(json.dumps(sainsburys_webpage_scraper.get_metrics()))
+		self.assertEqual(metrics['counters'], {'failures.xpath': 1, 'bytes.product_pages': 100, 'failures.connection': 1, 
+											   'failures.connection.ValueError': 1})
+		parse = metrics['timers']['parse']
+		self.assertEqual((parse['count'], parse['total_seconds'], parse['max_seconds']), (2, 0.625, 0.5))
+		self.assertEqual(dict(zip(metrics['timer_buckets'], parse['buckets'])), 
+						 dict((str(bound), 1 if bound in (0.2, 0.5) else 0) for bound in sainsburys_webpage_scraper.TIMER_BUCKETS))
+		self.assertEqual(metrics['timers']['product']['count'], 1)
+
+	def test_serve_snapshots(self):
+		'''The daemon should keep the latest and previous successful snapshots and serve them over HTTP.'''
+		stop = threading.Event()
+		snapshots = sainsburys_webpage_scraper.SnapshotCache()
+		json_strings = ['{"total": "1"}', '', '{"total": "2"}']
+		def produce():
+			if len(json_strings) == 1:
+				stop.set()
+			if json_strings[0] == '':
+				json_strings.pop(0)
+				raise ValueError()
+			return json_strings.pop(0)
+		sainsburys_webpage_scraper.serve_snapshots(produce, 0, interval=0, stop=stop, snapshots=snapshots)
+		self.assertEqual(snapshots.get('latest')[0], '{"total": "2"}')
+		self.assertEqual(snapshots.get('previous')[0], '{"total": "1"}')
+		status = snapshots.get_status()
+		self.assertEqual((status['runs'], status['failed_runs']), (3, 1))
+
+		server = sainsburys_webpage_scraper.SnapshotServer(('127.0.0.1', 0), snapshots)
+		self.addCleanup(server.server_close)
+		server_thread = threading.Thread(target=server.serve_forever)
+		server_thread.start()
+		self.addCleanup(server_thread.join)
+		self.addCleanup(server.shutdown)
+		url = 'http://127.0.0.1:%s' % server.server_address[1]
+		response = urllib2.urlopen(url + '/latest')
+		self.assertEqual(response.read(), '{"total": "2"}')
+		self.assertEqual(urllib2.urlopen(url + '/previous').read(), '{"total": "1"}')
+		with self.assertRaises(urllib2.HTTPError) as cm:
+			urllib2.urlopen(urllib2.Request(url + '/latest', headers={'If-None-Match': response.info()['ETag']}))
+		self.assertEqual(cm.exception.code, 304)
+		self.assertEqual(json.loads(urllib2.urlopen(url + '/status').read())['runs'], 3)
+		self.assertIn('counters', json.loads(urllib2.urlopen(url + '/metrics').read()))
+
+	@patch('sainsburys_webpage_scraper.random')
+	@patch('sainsburys_webpage_scraper.time')
+	def test_fetch_scheduler_retries(self, time_mock, random_mock):
+		'''Failed requests should be retried with a jittered backoff (or after Retry-After) until they succeed or run out of retries.'''
+		time_mock.time.return_value = 0
+		random_mock.uniform.side_effect = lambda low, high: high
+		self.addCleanup(sainsburys_webpage_scraper.configure_fetch_scheduler, False)
+		scheduler = sainsburys_webpage_scraper.configure_fetch_scheduler(retries=3)
+		responses = [Mock(status_code=503, headers={}), Mock(status_code=429, headers={'Retry-After': '7'}), 
+					 Mock(status_code=200, headers={})]
+		self.session_mock.get.side_effect = [ValueError()] + responses
+		self.assertIs(sainsburys_webpage_scraper.fetch('http://host/a'), responses[2])
+		self.assertEqual(self.session_mock.get.call_count, 4)
+		self.assertEqual([call[0][0] for call in time_mock.sleep.call_args_list], 
+						 [sainsburys_webpage_scraper.BACKOFF_BASE, sainsburys_webpage_scraper.BACKOFF_BASE * 2, 7])
+		responses[0].close.assert_called_once_with()
+		responses[1].close.assert_called_once_with()
+		self.assertEqual(scheduler.get_concurrency('host'), 2)  # halved once for the 3 failures, then +1
+
+		self.session_mock.get.reset_mock()
+		self.session_mock.get.side_effect = None
+		self.session_mock.get.return_value = Mock(status_code=500, headers={})
+		with self.assertRaises(sainsburys_webpage_scraper.FetchError):
+			sainsburys_webpage_scraper.fetch('http://host/a')
+		self.assertEqual(self.session_mock.get.call_count, 4)
+
+		self.session_mock.get.side_effect = ValueError()
+		with self.assertRaises(ValueError):
+			sainsburys_webpage_scraper.fetch('http://host/a')
+
+	@patch('sainsburys_webpage_scraper.time')
+	def test_fetch_scheduler_concurrency(self, time_mock):
+		'''The concurrency limit should grow while responses are fast and be halved once per window when they are slow.'''
+		time_mock.time.return_value = 0
+		limit = sainsburys_webpage_scraper._ConcurrencyLimit(4, latency_tolerance=4)
+		for _ in xrange(4):
+			limit.acquire()
+			limit.release(0, 0.1, False)
+		self.assertEqual(int(limit.limit), 4)
+		self.assertGreater(limit.limit, 4.9)
+		for _ in xrange(4):
+			limit.acquire()
+			limit.release(0, 0.1, False)
+		self.assertEqual(int(limit.limit), 5)
+
+		time_mock.time.return_value = 10
+		limit.release(5, 1, False)  # too slow
+		halved = limit.limit
+		self.assertAlmostEqual(halved, 2.85, places=1)
+		limit.release(5, 1, False)  # started before the decrease, same window
+		limit.release(9, 0.1, True)
+		self.assertEqual(limit.limit, halved)
+		limit.release(11, 0.1, True)
+		self.assertEqual(limit.limit, halved / 2)
+
+	def test_count_wire_bytes(self):
+		'''Compressed responses should be counted by the bytes read from the socket, next to their decompressed size.'''
+		self.addCleanup(sainsburys_webpage_scraper._metrics.reset)
+		sainsburys_webpage_scraper._metrics.reset()
+		response = Mock(content='x' * 4096, status_code=200, headers={'Content-Encoding': 'gzip'}, elapsed=Mock(**{'total_seconds.return_value': 0}))
+		response.raw.tell.return_value = 100
+		self.session_mock.get.return_value = response
+		self.tree_mock.xpath.return_value = []
+		with patch('sainsburys_webpage_scraper.METRICS_ENABLED', True):
+			self.assertEqual(sainsburys_webpage_scraper.get_product_page_details({}, 'link', {}), {})  # no description
+			sainsburys_webpage_scraper.count_wire_bytes(sainsburys_webpage_scraper.BufferedResponse('link', 200, {}, 'x'))
+		counters = sainsburys_webpage_scraper.get_metrics()['counters']
+		self.assertEqual((counters['bytes.wire'], counters['bytes.product_pages'], counters['content_encoding.gzip']), (100, 4096, 1))
+
+	def test_canonicalize_url(self):
+		'''URLs of the same page should have the same canonical form.'''
+		canonicalize_url = sainsburys_webpage_scraper.canonicalize_url
+		self.assertEqual(canonicalize_url('HTTP://Example.COM:80/p/1.html?b=2&utm_source=x&a=1&gclid=y#reviews'), 'http://example.com/p/1.html?a=1&b=2')
+		self.assertEqual(canonicalize_url('https://example.com:443'), 'https://example.com/')
+		self.assertEqual(canonicalize_url('https://example.com:8443/p?q='), 'https://example.com:8443/p?q=')
+		self.assertEqual(canonicalize_url('link'), 'link')
+		self.assertEqual(canonicalize_url(u'http://example.com/caf\xe9?name=caf\xe9'), 'http://example.com/caf%C3%A9?name=caf%C3%A9')
+		self.assertEqual(canonicalize_url('http://example.com/caf%c3%a9?name=caf%C3%A9'), canonicalize_url(u'http://example.com/caf\xe9?name=caf\xe9'))
+		self.assertEqual(canonicalize_url('http://example.com/a%20b;c=1?flag&q=&b=x+y&utm_medium'), 'http://example.com/a%20b;c=1?b=x+y&flag&q=')
+
+	@patch('sainsburys_webpage_scraper.get_product_additional_details_dict')
+	def test_extraction_memo(self, get_product_additional_details_dict_mock):
+		'''Identical pages should only be parsed once, in a bounded LRU memo, failures should not be remembered.'''
+		memo = sainsburys_webpage_scraper.configure_extraction_memo(2)
+		get_product_additional_details_dict_mock.side_effect = lambda content: {'description': content.upper()} if content != 'bad' else {}
+		extract = sainsburys_webpage_scraper.extract_product_additional_details_dict
+		for content in ['a', 'b', 'a', 'bad', 'bad', 'c', 'a', 'b']:
+			self.assertEqual(extract(content), {'description': content.upper()} if content != 'bad' else {})
+		self.assertEqual([c[0][0] for c in get_product_additional_details_dict_mock.call_args_list], ['a', 'b', 'bad', 'bad', 'c', 'b'])
+		self.assertEqual((memo.hits, memo.misses), (2, 6))
+		extract('a')['description'] = 'changed'
+		self.assertEqual(extract('a'), {'description': 'A'})  # copies are returned
+
+		sainsburys_webpage_scraper.start_run()  # pages are parsed once per run
+		extract('a')
+		self.assertEqual((memo.hits, memo.misses), (4, 7))
+
+		sainsburys_webpage_scraper.configure_extraction_memo(0)
+		extract('a')
+		self.assertEqual(len(get_product_additional_details_dict_mock.call_args_list), 8)
+
+	@patch('sainsburys_webpage_scraper._get_product_page_details')
+	def test_journal(self, get_product_page_details_mock):
+		'''Products should be journaled as they are done, a resumed run should only fetch the failed and new ones.'''
+		def get_product_page_details(product_details_dict, link, page_info=None):
+			if link.endswith('bad'):
+				sainsburys_webpage_scraper.count_failure('connection')
+				return {}
+			product_details_dict['description'] = link.upper()
+			return product_details_dict
+		get_product_page_details_mock.side_effect = get_product_page_details
+		get = sainsburys_webpage_scraper.get_product_page_details
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(tmp_dir, 'journal.ndjson')
+			sainsburys_webpage_scraper.configure_journal(path)
+			self.assertEqual(get({'title': 'A'}, 'http://a'), {'title': 'A', 'description': 'HTTP://A'})
+			self.assertEqual(get({'title': 'B'}, 'http://bad'), {})
+			sainsburys_webpage_scraper.configure_journal(None)
+			with open(path, 'ab') as f:
+				f.write('{"url": "http://c", "prod')  # the process died while writing
+
+			journal = sainsburys_webpage_scraper.configure_journal(path, resume=True)
+			self.assertEqual((journal.failed, len(journal.products)), ({'http://bad': ['connection']}, 1))
+			self.assertEqual(get({'title': 'A2'}, 'http://a'), {'title': 'A2', 'description': 'HTTP://A'})
+			self.assertEqual(get({'title': 'C'}, 'http://c'), {'title': 'C', 'description': 'HTTP://C'})
+			self.assertEqual([c[0][1] for c in get_product_page_details_mock.call_args_list], ['http://a', 'http://bad', 'http://c'])
+			sainsburys_webpage_scraper.configure_journal(None)
+			self.assertEqual(sorted(sainsburys_webpage_scraper.Journal(path, resume=True).products), ['http://a', 'http://c'])
+		finally:
+			sainsburys_webpage_scraper.configure_journal(None)
+			shutil.rmtree(tmp_dir)
+
+	def test_http_archive(self):
+		'''Responses recorded in the HTTP archive should be replayed without any request, also if it was not closed.'''
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(tmp_dir, 'pages.archive')
+			sainsburys_webpage_scraper.configure_http_archive(path, record=True)
+			for url, content in [('http://a', 'A' * 100), ('http://b', ''), ('http://a', 'A2')]:
+				type(self.response_mock).content = PropertyMock(return_value=content)
+				self.response_mock.status_code = 200 if content else 404
+				self.response_mock.headers = {'ETag': url, 'Content-Encoding': 'gzip'}
+				self.assertEqual(sainsburys_webpage_scraper.fetch(url, stream=True), self.response_mock)
+			sainsburys_webpage_scraper.configure_http_archive(None)
+			with open(path, 'rb') as f:
+				archive_content = f.read()
+
+			self.session_mock.get.reset_mock()
+			# Without its index (the recording process died) and cut short in the last response, the first one is replayed.
+			for archive_content, content_a in [(archive_content, 'A2'), (archive_content[:archive_content.rindex('A2') + 1], 'A' * 100)]:
+				with open(path, 'wb') as f:
+					f.write(archive_content)
+				archive = sainsburys_webpage_scraper.configure_http_archive(path)
+				self.assertEqual(archive.offsets.keys(), ['http://a', 'http://b'])
+				response = sainsburys_webpage_scraper.fetch('http://b')
+				self.assertEqual((response.status_code, response.headers, response.content), (404, {'ETag': 'http://b'}, ''))
+				response = sainsburys_webpage_scraper.fetch(u'http://a')
+				self.assertEqual((response.status_code, response.content), (200, content_a))
+				self.assertRaises(sainsburys_webpage_scraper.FetchError, sainsburys_webpage_scraper.fetch, 'http://c')
+				sainsburys_webpage_scraper.configure_http_archive(None)
+			self.assertFalse(self.session_mock.get.called)
+		finally:
+			sainsburys_webpage_scraper.configure_http_archive(None)
+			shutil.rmtree(tmp_dir)
+
 	def test_get_product_unit_price(self):
 		'''Should return None if unit_price could not be retrieved or if it is in bad shape.'''
 		# Could not get unit price (case 1):
@@ -220,6 +942,17 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 		self.logging_mock.reset_mock()
 
 		with patch('sainsburys_webpage_scraper.isinstance') as isinstance_mock:
+			# Product id:
+			isinstance_mock.return_value = True
+			div_mock_1.getchildren.return_value = [div_mock_2]
+			div_mock_2.get.side_effect = lambda attribute: {'class': 'priceTab activeContainer priceTabContainer', 'id': 'addItem_149117'}[attribute]
+			self.assertEqual(sainsburys_webpage_scraper.get_product_id(self.li_mock1), '149117')
+			div_mock_2.get.side_effect = lambda attribute: {'class': 'priceTab activeContainer priceTabContainer', 'id': 'addItem_'}[attribute]
+			self.assertEqual(sainsburys_webpage_scraper.get_product_id(self.li_mock1), None)
+			self.assertTrue(len(self.logging_mock.error.call_args_list) == 1)
+			self.logging_mock.reset_mock()
+			div_mock_2.get.side_effect = None
+
 			# Could not get unit price (case 3):
 			isinstance_mock.return_value = True 
 			div_mock_1.getchildren.return_value = [Mock(), Mock()]  # more than 1 element in list after filter
@@ -280,6 +1013,60 @@ class SainsburysWebpageScraperUnitTests(unittest.TestCase):
 		self.html_mock.parse.assert_called_once_with(self.StringIO_mock('abc'), parser=self.html_mock.HTMLParser())
 
 
+	def test_get_product_description_fast(self):
+		'''Should find the description without parsing the page and return None whenever the markup is ambiguous.'''
+		self.assertEqual(sainsburys_webpage_scraper.get_product_description_fast(PRODUCT_PAGE), 'Apricots')
+		for product_page_content in [
+			'<html></html>',
+			PRODUCT_PAGE.replace('<title>', '<!-- <title>'),  # unterminated
+			PRODUCT_PAGE.replace('<title>', '<script>var a = "<div class=\\"productText\\">";'),
+			PRODUCT_PAGE.replace('<title>', '<STYLE type="text/css">'),
+			PRODUCT_PAGE.replace('<div class="productText"><p>  Apricots', '<div class="productText" id="x"><p>  Apricots'),
+			PRODUCT_PAGE.replace('<p>  Apricots', '<h4>Apricots</h4><p>  Apricots'),
+			PRODUCT_PAGE.replace('Apricots\n', 'Apricots &amp; Kiwis\n'),
+			PRODUCT_PAGE.replace('Apricots\n', 'Apricots \xc3\xa9\n'),
+			PRODUCT_PAGE.replace('<p>  Apricots\n', '<p>  '),
+			PRODUCT_PAGE.replace('Apricots\n', 'Apri\x01cots\n'),
+			# A <div class="productText"> first, but not where the selector looks:
+			PRODUCT_PAGE.replace('<div id="page">', '<div class="productText"><p>Promo</p></div><div id="page">'),
+			PRODUCT_PAGE.replace('<div id="page">', '<noscript><div class="productText"><p>N</p></div></noscript><div id="page">'),
+			PRODUCT_PAGE.replace('<h3 class', '<textarea><div class="productText"><p>T</p></div></textarea><h3 class'),
+			PRODUCT_PAGE.replace('<htmlcontent>', '<htmlcontent><div class="promo">'),
+		]:
+			self.assertIsNone(sainsburys_webpage_scraper.get_product_description_fast(product_page_content))
+		with patch('sainsburys_webpage_scraper._overridden_selectors', set(['description'])):
+			self.assertIsNone(sainsburys_webpage_scraper.get_product_description_fast(PRODUCT_PAGE))
+
+	def test_get_product_description_fast_head(self):
+		'''Complete comments, <script> and <style> elements should be skipped, along with any markup in them.'''
+		head = '''<head><!--[if IE]><div class="productText"><p>IE</p></div><![endif]-->
+<script type="text/javascript">if (a < b) { document.write('<div class="productText"><p>JS</p></div>'); }</script >
+<SCRIPT src="/a.js"></SCRIPT><style>.productText > p { margin: 0; }</style><title>Apricots</title></head>'''
+		product_page_content = PRODUCT_PAGE.replace('<head><title>Apricots</title></head>', head)
+		self.assertEqual(sainsburys_webpage_scraper.get_product_description_fast(product_page_content), 'Apricots')
+		with patch('sainsburys_webpage_scraper.html', HTML), patch('sainsburys_webpage_scraper.StringIO', StringIO):
+			self.select_mock.side_effect = SELECT
+			self.assertEqual(sainsburys_webpage_scraper._get_product_additional_details_dict(product_page_content), {'description': 'Apricots'})
+
+	@patch('sainsburys_webpage_scraper.get_product_description_fast')
+	def test_get_product_additional_details_dict_fast(self, get_product_description_fast_mock):
+		'''With FAST_EXTRACT the page should only be parsed when the fast path fails or when verifying it.'''
+		self.tree_mock.xpath.return_value = [Mock(**{'xpath.return_value': [Mock(text=' 123 ')]})]
+		with patch('sainsburys_webpage_scraper.FAST_EXTRACT', True):
+			get_product_description_fast_mock.return_value = '123'
+			self.assertEqual(sainsburys_webpage_scraper.get_product_additional_details_dict('abc'), {'description': '123'})
+			self.assertFalse(self.html_mock.parse.called)
+
+			get_product_description_fast_mock.return_value = None
+			self.assertEqual(sainsburys_webpage_scraper.get_product_additional_details_dict('abc'), {'description': '123'})
+			self.html_mock.parse.assert_called_once_with(self.StringIO_mock('abc'), parser=self.html_mock.HTMLParser())
+
+			with patch('sainsburys_webpage_scraper.VERIFY_FAST_EXTRACT', True):
+				get_product_description_fast_mock.return_value = '12'
+				self.assertEqual(sainsburys_webpage_scraper.get_product_additional_details_dict('abc'), {'description': '123'})
+				self.assertEqual(len(self.html_mock.parse.call_args_list), 2)
+				self.assertTrue(len(self.logging_mock.warn.call_args_list) == 1)
+
 class SainsburysWebpageScraperBehaviouralTests(unittest.TestCase):
 	def test_1(self):
 		json_string = sainsburys_webpage_scraper.get_ripe_fruits_json()